@@ -11,4 +11,8 @@ then
     echo "PostgreSQL started"
 fi
 
+# size variants of the covers saved before they were introduced
+# (and of the default one), such covers are shown as the default one
+python manage.py backfill_cover_variants
+
 exec "$@"
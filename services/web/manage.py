@@ -1,7 +1,18 @@
+import sys
+import time
+
+import click
 from flask.cli import FlaskGroup
+from flask_migrate import stamp
 
 from project import app, db
-from project.db_handlers import make_db_data, delete_all_files_in_dir
+from project.bench import (bench_cover_upload, bench_map_data,
+                           bench_suggest, check_replica_routing,
+                           explain_handlers, hammer_instance_counters)
+from project.db_handlers import (make_db_data, delete_all_files_in_dir,
+                                 rebuild_fresh_listings,
+                                 update_users_geo_cells)
+from project.utils import backfill_cover_variants, expired_bi_handler
 
 cli = FlaskGroup(app)
 
@@ -15,11 +26,123 @@ def create_db():
 
     delete_all_files_in_dir('project/static/covers')
     db.create_all()
+    stamp()  # the schema is up to date, mark it for 'flask db upgrade'
 
 
 @cli.command("seed_db")
-def seed_db():
-    make_db_data(db)
+@click.option('--users', default=15, show_default=True)
+@click.option('--books', default=15, show_default=True)
+@click.option('--book-instances', default=60, show_default=True)
+@click.option('--messages', default=0, show_default=True)
+@click.option('--batch-size', default=10000, show_default=True,
+              help='Rows per bulk insert')
+@click.option('--seed', type=int, default=None,
+              help='Random seed to reproduce the same data')
+def seed_db(users, books, book_instances, messages, batch_size, seed):
+    """ Fill DB with fake users, books, book instances & messages, e.g.
+    seed_db --users 100000 --books 1000000 --book-instances 5000000
+    --messages 1000000 for production size load testing
+    """
+    start = time.perf_counter()
+    make_db_data(db, users=users, books=books, book_instances=book_instances,
+                 messages=messages, batch_size=batch_size, seed=seed)
+    backfill_cover_variants()
+    print(f'Done in {time.perf_counter() - start:.1f} s')
+
+
+@cli.command("update_geo_cells")
+def update_geo_cells():
+    """ Fill User.geo_cell (spatial index) for existing users """
+    print(f'{update_users_geo_cells()} users updated')
+
+
+@cli.command("bench_map_data")
+def bench_map_data_command():
+    """ Show that /api/map_data cost doesn't grow with listings number """
+    bench_map_data()
+
+
+@cli.command("backfill_cover_variants")
+@click.option('--force', is_flag=True,
+              help='Remake the variants of all the covers.')
+def backfill_cover_variants_command(force):
+    """ Make WebP / JPEG size variants of the existing covers """
+    print(f'{backfill_cover_variants(force)} covers converted')
+
+
+@cli.command("bench_cover_upload")
+def bench_cover_upload_command():
+    """ Show CPU time & memory of a cover upload for big phone photos """
+    bench_cover_upload()
+
+
+@cli.command("bench_suggest")
+@click.option('--books', type=int, multiple=True,
+              help='Catalog size, 10000, 100000 and 1000000 by default.')
+def bench_suggest_command(books):
+    """ Show search-as-you-type time for short prefixes on a big catalog
+    (exit code 1 if the suggestions aren't the best books)
+    """
+    if not bench_suggest(*([books] if books else [])):
+        sys.exit(1)
+
+
+@cli.command("explain_queries")
+def explain_queries():
+    """ Check that db_handlers queries use indexes (exit code 1 if not) """
+    if not explain_handlers():
+        sys.exit(1)
+
+
+@cli.command("check_counters")
+def check_counters():
+    """ Check Book.instance_counter stays exact under concurrent create /
+    delete of book instances (exit code 1 if not)
+    """
+    if not hammer_instance_counters():
+        sys.exit(1)
+
+
+@cli.command("check_replica_routing")
+def check_replica_routing_command():
+    """ Check read-only handlers use the replica, writes - the primary
+    (exit code 1 if not)
+    """
+    if not check_replica_routing():
+        sys.exit(1)
+
+
+@cli.command("rebuild_fresh_listings")
+def rebuild_fresh_listings_command():
+    """ Refill the home page feed of fresh listings from book instances """
+    print(f'{rebuild_fresh_listings()} fresh listings')
+
+
+@cli.command("expire_book_instances")
+@click.option('--days', type=int, default=None,
+              help='Expiration period, EXPIRATION_PERIOD_DAYS by default.')
+@click.option('--chunk-size', type=int, default=None,
+              help='Rows per transaction, EXPIRED_BI_CHUNK_SIZE by default.')
+def expire_book_instances(days, chunk_size):
+    """ Deactivate expired book instances & notify their owners now """
+    metrics = expired_bi_handler(
+        days or app.config['EXPIRATION_PERIOD_DAYS'],
+        chunk_size or app.config['EXPIRED_BI_CHUNK_SIZE'],
+    )
+    print(metrics)
+
+
+@cli.command("create_trgm_index")
+def create_trgm_index():
+    """ PostgreSQL only. Enable pg_trgm & index Book title/author with it.
+    Then set SEARCH_USE_PG_TRGM=1 to use it in search.
+    """
+    db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for column in ('title', 'author'):
+        db.session.execute(
+            f'CREATE INDEX IF NOT EXISTS ix_book_{column}_trgm '
+            f'ON book USING gin ({column} gin_trgm_ops)')
+    db.session.commit()
 
 
 if __name__ == "__main__":
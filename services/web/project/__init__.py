@@ -5,18 +5,18 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 import logging
 import os
 from logging.handlers import RotatingFileHandler
 from .config import Config
+from .replica import RoutingSQLAlchemy
 
 app = Flask(__name__)
 app.secret_key = '!secret'
 
 app.config.from_object(Config)
 admin = Admin(app, template_mode='bootstrap3')
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
 migrate = Migrate(app, db)
 login = LoginManager(app)
 login.login_view = 'login'
@@ -0,0 +1,437 @@
+import io
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Thread
+from typing import List
+
+from PIL import Image
+from sqlalchemy import event, func
+
+from . import db
+from .models import Book, BookInstance, User
+
+'''
+Helpers to benchmark handlers: count SQL queries & filesystem calls, check
+query plans, counters consistency, read replica routing, cover uploads and
+search-as-you-type. Used by manage.py bench_*, explain_queries,
+check_counters and check_replica_routing commands.
+'''
+
+
+@contextmanager
+def count_calls():
+    """ Counts SQL queries and os.stat() / os.listdir() calls inside the
+    context. Yields dict, it's filled on exit: queries, stats, listdirs, time.
+    """
+    counters = {'queries': 0, 'stats': 0, 'listdirs': 0, 'time': 0.0}
+    original_stat, original_listdir = os.stat, os.listdir
+
+    def _on_execute(*args, **kwargs):
+        counters['queries'] += 1
+
+    def _stat(*args, **kwargs):
+        counters['stats'] += 1
+        return original_stat(*args, **kwargs)
+
+    def _listdir(*args, **kwargs):
+        counters['listdirs'] += 1
+        return original_listdir(*args, **kwargs)
+
+    event.listen(db.engine, 'before_cursor_execute', _on_execute)
+    os.stat, os.listdir = _stat, _listdir
+    start = time.perf_counter()
+    try:
+        yield counters
+    finally:
+        counters['time'] = time.perf_counter() - start
+        os.stat, os.listdir = original_stat, original_listdir
+        event.remove(db.engine, 'before_cursor_execute', _on_execute)
+
+
+def bench_map_data(sizes=(1, 10, 100, 1000, 10000)) -> None:
+    """ Prints queries & filesystem calls made by utils.get_map_data()
+    for growing number of books (and so listings) on the map.
+    """
+    from .utils import get_map_data, has_cover
+
+    has_cover(0)  # warm up covers manifest
+    all_ids = [book_id for book_id, in
+               db.session.query(Book.id).order_by(Book.id)]
+    print(f'{"books":>8} {"markers":>8} {"queries":>8} {"stats":>8} '
+          f'{"listdirs":>8} {"ms":>8}')
+    for size in sizes:
+        book_ids = all_ids[:size]
+        with count_calls() as counters:
+            markers = len(get_map_data(book_ids=book_ids)['features'])
+        print(f'{len(book_ids):>8} {markers:>8} {counters["queries"]:>8} '
+              f'{counters["stats"]:>8} {counters["listdirs"]:>8} '
+              f'{counters["time"] * 1000:>8.1f}')
+        if size > len(all_ids):
+            break
+
+
+@contextmanager
+def capture_queries():
+    """ Yields list, it's filled with (statement, parameters) of all SQL
+    queries executed inside the context.
+    """
+    statements = []
+
+    def _on_execute(conn, cursor, statement, parameters, context, many):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', _on_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', _on_execute)
+
+
+def _explain(statement: str, parameters) -> List[str]:
+    """ Returns query plan lines (SQLite or PostgreSQL) """
+    raw_connection = db.engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        if db.engine.dialect.name == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [row[-1] for row in cursor.fetchall()]
+        cursor.execute('EXPLAIN ' + statement, parameters)
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        raw_connection.close()
+
+
+def _is_full_scan(plan_line: str) -> bool:
+    line = plan_line.strip()
+    if line.startswith('SCAN '):  # SQLite
+        return 'INDEX' not in line
+    return 'Seq Scan' in line  # PostgreSQL
+
+
+def explain_handlers() -> bool:
+    """ Runs db_handlers queries (filtered by some column) on the current DB,
+    prints their query plans. Returns False if any of them makes a full table
+    scan, i.e. doesn't use an index.
+    Makes sense on big tables only (see manage.py seed_db): on tiny ones
+    PostgreSQL prefers Seq Scan anyway.
+    """
+    from . import db_handlers as h
+
+    user = User.query.order_by(User.id).first()
+    book = Book.query.order_by(Book.id).first()
+    if user is None or book is None:
+        print('DB is empty, fill it first (manage.py seed_db)')
+        return False
+    latitude, longitude = user.latitude or 0, user.longitude or 0
+    bbox = (longitude - 0.05, latitude - 0.05, longitude + 0.05, latitude + 0.05)
+
+    handlers = (
+        ('get_book_instances_by_user_id',
+         lambda: h.get_book_instances_by_user_id(user.id)),
+        ('get_book_instances_by_book_id',
+         lambda: h.get_book_instances_by_book_id(book.id)),
+        ('get_freshest_book_instances',
+         lambda: h.get_freshest_book_instances(30)),
+        ('get_active_bi_locations(book_ids)',
+         lambda: h.get_active_bi_locations(book_ids=[book.id])),
+        ('get_active_bi_locations(bbox)',
+         lambda: h.get_active_bi_locations(bbox=bbox)),
+        ('get_active_bi_nearby',
+         lambda: h.get_active_bi_nearby(latitude, longitude, 5)),
+        ('get_library_page',
+         lambda: h.get_library_page(after=book.id)),
+        ('get_book_by_isbn',
+         lambda: h.get_book_by_isbn(book.isbn or 9780306406157)),
+        ('get_book_id', lambda: h.get_book_id(book.title, book.author)),
+        ('book_counter_created_by_user',
+         lambda: h.book_counter_created_by_user(user.id)),
+        ('get_messages_by_user',
+         lambda: h.get_messages_by_user(user.id)),
+        ('User.new_messages', lambda: user.new_messages()),
+        ('get_expired_bi_chunk',
+         lambda: h.get_expired_bi_chunk(datetime.utcnow(), (user.id, 0))),
+    )
+
+    all_indexed = True
+    for name, handler in handlers:
+        with capture_queries() as statements:
+            handler()
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            plan = _explain(statement, parameters)
+            full_scan = any(_is_full_scan(line) for line in plan)
+            all_indexed = all_indexed and not full_scan
+            print(f'{"FULL SCAN" if full_scan else "OK":<10} {name}')
+            for line in plan:
+                print(f'{"":<10}   {line}')
+    return all_indexed
+
+
+def hammer_instance_counters(threads: int = 8, operations: int = 50) -> bool:
+    """ Creates and deletes book instances from many threads at once, then
+    checks every Book.instance_counter equals the number of its instances.
+    Every thread also tries to delete the same instances at the end, so
+    concurrent deletes of one row are covered. The DB is left as it was.
+    Returns True if the counters are exact and no thread failed.
+    """
+    from . import app
+    from .db_handlers import create_book_instance, delete_book_instance
+
+    owner_id = db.session.query(User.id).order_by(User.id).limit(1).scalar()
+    book_ids = [book_id for book_id, in
+                db.session.query(Book.id).order_by(Book.id).limit(5)]
+    if owner_id is None or not book_ids:
+        print('DB is empty, fill it first (manage.py seed_db)')
+        return False
+    shared_ids = [
+        create_book_instance(1, 1, 'counters check', owner_id, book_id).id
+        for book_id in book_ids]
+    errors = []
+
+    def worker(seed: int) -> None:
+        rnd = random.Random(seed)
+        created = []
+        with app.app_context():
+            try:
+                for _ in range(operations):
+                    if created and rnd.random() < 0.5:
+                        delete_book_instance(
+                            created.pop(rnd.randrange(len(created))))
+                    else:
+                        created.append(create_book_instance(
+                            1, 1, 'counters check', owner_id,
+                            rnd.choice(book_ids)).id)
+                for book_instance_id in created + shared_ids:
+                    delete_book_instance(book_instance_id)
+            except Exception as e:
+                db.session.rollback()
+                errors.append(e)
+
+    workers = [Thread(target=worker, args=(seed,)) for seed in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    db.session.expire_all()
+    counts = dict(db.session.query(BookInstance.book_id, func.count())
+                  .group_by(BookInstance.book_id))
+    wrong = [(book_id, instance_counter, counts.get(book_id, 0))
+             for book_id, instance_counter in
+             db.session.query(Book.id, Book.instance_counter)
+             if instance_counter != counts.get(book_id, 0)]
+    print(f'{threads} threads x {operations} operations: '
+          f'{elapsed * 1000:.0f} ms, {len(errors)} errors')
+    for error in errors:
+        print(f'  error: {error!r}')
+    for book_id, instance_counter, count in wrong:
+        print(f'  book {book_id}: instance_counter={instance_counter}, '
+              f'instances={count}')
+    return not errors and not wrong
+
+
+def check_replica_routing() -> bool:
+    """ Checks that read-only handlers query the replica and writes go to
+    the primary (see replica.py). Prints number of queries per database.
+    """
+    from . import app
+    from . import db_handlers as h
+    from .replica import REPLICA_BIND, replica
+
+    if REPLICA_BIND not in app.config['SQLALCHEMY_BINDS']:
+        print('No replica configured, set REPLICA_DATABASE_URL')
+        return False
+    replica_engine = db.get_engine(app, bind=REPLICA_BIND)
+    title = db.session.query(Book.title).order_by(Book.id).limit(1).scalar()
+    db.session.rollback()
+
+    def queries_by_engine(func) -> dict:
+        counters = {'primary': 0, 'replica': 0}
+
+        def _on_primary(*args, **kwargs):
+            counters['primary'] += 1
+
+        def _on_replica(*args, **kwargs):
+            counters['replica'] += 1
+
+        event.listen(db.engine, 'before_cursor_execute', _on_primary)
+        event.listen(replica_engine, 'before_cursor_execute', _on_replica)
+        try:
+            func()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', _on_primary)
+            event.remove(replica_engine, 'before_cursor_execute',
+                         _on_replica)
+            db.session.rollback()
+        return counters
+
+    def write_inside_replica_context():
+        with replica():
+            h.incr_instance_counter(0)  # no such book, nothing is changed
+
+    checks = (
+        ('get_freshest_book_instances', 'replica',
+         lambda: h.get_freshest_book_instances(30)),
+        ('get_library_page', 'replica', lambda: h.get_library_page()),
+        # the search index is synced from the primary, the books are read
+        # from the replica
+        ('get_books_by_kw', 'both', lambda: h.get_books_by_kw(title or 'book')),
+        ('get_analytics', 'replica', lambda: h.get_analytics()),
+        ('get_book', 'primary', lambda: h.get_book(1)),
+        ('write inside replica()', 'primary', write_inside_replica_context),
+    )
+    routed = True
+    for name, expected, check in checks:
+        counters = queries_by_engine(check)
+        if expected == 'both':
+            is_ok = counters['primary'] > 0 and counters['replica'] > 0
+        else:
+            other = 'primary' if expected == 'replica' else 'replica'
+            is_ok = counters[expected] > 0 and counters[other] == 0
+        routed = routed and is_ok
+        print(f'{"OK" if is_ok else "WRONG":<6} {name:<30} '
+              f'primary: {counters["primary"]}, '
+              f'replica: {counters["replica"]}')
+    return routed
+
+
+def bench_suggest(
+        sizes=(10000, 100000, 1000000),
+        queries=('a', 'th', 'the', 'ho', 'sil', 'war', 'winter s', 'iv'),
+        repeat: int = 5) -> bool:
+    """ Prints time of search.SearchIndex.suggest() on a synthetic catalog
+    of growing size (no DB, titles and authors like seed.py makes, skewed
+    instance counters) against the scan of all the books of the prefix.
+    Returns False if any suggestions differ from the scan ones.
+    """
+    import heapq
+
+    import numpy as np
+
+    from .search import SearchIndex, tokenize
+    from .seed import FIRST_NAMES, LAST_NAMES, TITLE_WORDS
+
+    rng = np.random.default_rng(0)
+    same = True
+    print(f'{"books":>8} {"query":>10} {"suggest ms":>11} {"scan ms":>8} '
+          f'{"same":>5}')
+    for size in sizes:
+        index = SearchIndex()
+        index.sync = lambda: None  # the catalog isn't in DB
+        words = rng.integers(0, len(TITLE_WORDS), (size, 3))
+        rare_words = rng.integers(0, max(size // 10, 1), size)
+        first_names = rng.integers(0, len(FIRST_NAMES), size)
+        last_names = rng.integers(0, len(LAST_NAMES), size)
+        counters = (100 * rng.random(size) ** 8).astype(int)
+        for i in range(size):
+            title = (' '.join(TITLE_WORDS[w] for w in words[i])
+                     + ' ' + np.base_repr(int(rare_words[i]), 36))
+            author = f'{FIRST_NAMES[first_names[i]]} ' \
+                     f'{LAST_NAMES[last_names[i]]}'
+            index._index(i + 1, title, author, int(counters[i]))
+        index._sorted_tokens = sorted(index._postings)
+
+        for query in queries:
+            *query_words, prefix = tokenize(query)
+            index.suggest(query)  # warm up the top books of the tokens
+            start = time.perf_counter()
+            for _ in range(repeat):
+                suggestions = index.suggest(query)
+            suggest_ms = (time.perf_counter() - start) / repeat * 1000
+
+            start = time.perf_counter()
+            books = {book_id for token in index._prefix_tokens(prefix)
+                     for book_id in index._postings[token]}
+            for word in query_words:
+                books.intersection_update(index._postings.get(word, ()))
+            scanned = heapq.nsmallest(len(suggestions) or 10, books,
+                                      key=index._rank)
+            scan_ms = (time.perf_counter() - start) * 1000
+
+            same = same and scanned == suggestions
+            print(f'{size:>8} {query:>10} {suggest_ms:>11.2f} '
+                  f'{scan_ms:>8.1f} {str(scanned == suggestions):>5}')
+    return same
+
+
+def _phone_photo(width: int, height: int, orientation: int = 1) -> bytes:
+    """ Returns JPEG of the size with some detail (noise), like a photo """
+    noise = Image.effect_noise((width // 8, height // 8), 64)
+    image = Image.merge('RGB', (noise, noise.rotate(90, expand=False),
+                                noise.transpose(Image.FLIP_LEFT_RIGHT)))
+    image = image.resize((width, height), Image.BILINEAR)
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+def bench_cover_upload(
+        sizes=((3000, 4000), (4032, 3024), (6000, 8000)),
+        repeat: int = 3) -> None:
+    """ Prints CPU time per cover upload and size of the decoded image
+    (the peak memory of the upload, Pillow buffers aren't seen by
+    tracemalloc) for phone photo sizes: the old way (save the original,
+    decode it in full, crop) and the current one (utils.cover_upload:
+    draft mode decoding from the upload stream). Both save the same files,
+    the cover with its size variants (thumbs.save_cover_files).
+    """
+    from . import app
+    from .thumbs import crop, save_cover_files
+    from .utils import cover_upload
+
+    target_x, target_y = [int(i) for i in
+                          app.config['IMAGE_TARGET_SIZE'].split('x')]
+    print(f'{"photo":>10} {"way":>8} {"cpu ms":>8} {"decoded MB":>11}')
+    with tempfile.TemporaryDirectory() as folder, \
+            app.test_request_context():
+        original_folder = app.config['IMAGE_UPLOADS']
+        app.config['IMAGE_UPLOADS'] = folder
+        try:
+            for width, height in sizes:
+                photo = _phone_photo(width, height, orientation=6)
+
+                def old_way():
+                    filepath = os.path.join(folder, '0.jpg')
+                    with open(filepath, 'wb') as f:
+                        f.write(photo)
+                    image = Image.open(filepath)
+                    image.load()
+                    decoded = image.size
+                    save_cover_files(crop(image, target_x, target_y), folder,
+                                     0, app.config['COVER_VARIANTS'],
+                                     app.config['COVER_QUALITY'])
+                    return decoded
+
+                def new_way():
+                    decoded = []
+                    original_load = Image.Image.load
+
+                    def load(image):  # size of the decoded image
+                        pixels = original_load(image)
+                        decoded.append(image.size)
+                        return pixels
+                    Image.Image.load = load
+                    try:
+                        cover_upload(io.BytesIO(photo), 0)
+                    finally:
+                        Image.Image.load = original_load
+                    return decoded[0]
+
+                for name, way in (('old', old_way), ('new', new_way)):
+                    start = time.process_time()
+                    for _ in range(repeat):
+                        decoded_x, decoded_y = way()
+                    cpu = (time.process_time() - start) / repeat
+                    print(f'{width}x{height:<5} {name:>8} {cpu * 1000:>8.1f} '
+                          f'{decoded_x * decoded_y * 4 / 2 ** 20:>11.1f}')
+        finally:
+            app.config['IMAGE_UPLOADS'] = original_folder
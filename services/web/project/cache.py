@@ -0,0 +1,204 @@
+import sys
+import time
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from typing import Callable, Dict, Hashable
+
+from flask import g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from . import app, db
+
+'''
+Process-local read-through cache for hot entity lookups (book owners,
+the book / book instance pages). current_user isn't read through it,
+see models.load_user.
+
+Entries are kept per entity ('user', 'book', 'book_instance') for
+ENTITY_CACHE_TTLS seconds (0 disables the entity) and evicted least recently
+used first when their estimated size exceeds ENTITY_CACHE_MAX_BYTES.
+ORM objects are stored as their column values and merged into the current
+session without a query (session.merge(load=False)), so a cached object
+is never shared between sessions / threads. Inside one request the same
+lookup returns the same object without touching the cache at all (not in
+background jobs: their app context may live long).
+
+The handlers changing the rows by bulk UPDATE / DELETE invalidate them
+explicitly, ORM flushes of User, Book, BookInstance (e.g. admin panel) do it
+via mapper events. The invalidation is local to the process: other workers
+may see the old row until its TTL is over, so keep TTLs short.
+
+Hits / misses per entity: entity_cache.stats(), see the admin analytics page.
+'''
+
+
+class _Columns:
+    """ Column values of cached ORM object """
+    __slots__ = ('model', 'values')
+
+    def __init__(self, model, values: dict):
+        self.model = model
+        self.values = values
+
+
+def _snapshot(value):
+    """ Value to store: column values of ORM object, the value itself
+    otherwise (row tuples are immutable)
+    """
+    if isinstance(value, db.Model):
+        return _Columns(type(value), {
+            attr.key: getattr(value, attr.key)
+            for attr in db.inspect(value).mapper.column_attrs})
+    return value
+
+
+def _restore(stored):
+    """ Stored value back, ORM object is attached to the current session """
+    if not isinstance(stored, _Columns):
+        return stored
+    obj = stored.model()
+    for key, value in stored.values.items():
+        setattr(obj, key, value)
+    make_transient_to_detached(obj)  # as if loaded, nothing to flush
+    return db.session.merge(obj, load=False)
+
+
+def _size(stored) -> int:
+    """ Estimated size of stored value in bytes """
+    if isinstance(stored, _Columns):
+        values = stored.values.values()
+    elif isinstance(stored, tuple):
+        values = stored
+    else:
+        values = ()
+    return sys.getsizeof(stored) + sum(sys.getsizeof(v) for v in values)
+
+
+class EntityCache:
+
+    def __init__(self, ttls: Dict[str, float], max_bytes: int):
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        # (entity, key) -> (expires, size, stored value), LRU order
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._stats = {entity: {'hits': 0, 'misses': 0, 'evictions': 0}
+                       for entity in ttls}
+        self._lock = Lock()
+
+    def get(self, entity: str, key: Hashable, load: Callable):
+        """ Returns the cached value or the one returned by load()
+        (None isn't cached). Memoized for the current request.
+        """
+        ttl = self.ttls.get(entity, 0)
+        if not ttl:
+            return load()
+        memo = self._memo()
+        if (entity, key) in memo:
+            return memo[entity, key]
+
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get((entity, key))
+            if cached and cached[0] > now:
+                self._entries.move_to_end((entity, key))
+                self._stats[entity]['hits'] += 1
+            else:
+                cached = None
+                self._stats[entity]['misses'] += 1
+        if cached:
+            value = _restore(cached[2])
+        else:
+            value = load()
+            if value is not None:
+                self._put(entity, key, now + ttl, _snapshot(value))
+        memo[entity, key] = value
+        return value
+
+    def _put(self, entity: str, key: Hashable, expires: float, stored):
+        size = _size(stored)
+        with self._lock:
+            previous = self._entries.pop((entity, key), None)
+            if previous:
+                self._bytes -= previous[1]
+            self._entries[entity, key] = (expires, size, stored)
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                (evicted, _), (_, evicted_size, _) = \
+                    self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._stats[evicted]['evictions'] += 1
+
+    def invalidate(self, entity: str, key: Hashable = None) -> None:
+        """ Forget the entry, or all entries of the entity if key is None """
+        with self._lock:
+            keys = ([(entity, key)] if key is not None else
+                    [k for k in self._entries if k[0] == entity])
+            for cache_key in keys:
+                removed = self._entries.pop(cache_key, None)
+                if removed:
+                    self._bytes -= removed[1]
+        memo = self._memo()
+        for cache_key in [k for k in memo if k[0] == entity
+                          and (key is None or k[1] == key)]:
+            del memo[cache_key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        self._memo().clear()
+
+    def stats(self) -> dict:
+        """ Returns hits, misses, evictions per entity and entries, bytes
+        of the cache
+        """
+        with self._lock:
+            return {
+                'entities': {entity: dict(counters)
+                             for entity, counters in self._stats.items()},
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    @staticmethod
+    def _memo() -> dict:
+        """ Lookups memo of the current request, none outside requests """
+        if not has_request_context():
+            return dict()
+        if 'entity_cache_memo' not in g:
+            g.entity_cache_memo = dict()
+        return g.entity_cache_memo
+
+
+entity_cache = EntityCache(
+    ttls=app.config['ENTITY_CACHE_TTLS'],
+    max_bytes=app.config['ENTITY_CACHE_MAX_BYTES'],
+)
+
+
+def cached(entity: str):
+    """ Decorator of db_handlers getter by id: read it through entity_cache.
+    The getter itself (reading DB) is func.__wrapped__.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(key):
+            try:
+                cache_key = int(key)
+            except (TypeError, ValueError):
+                return func(key)
+            return entity_cache.get(entity, cache_key, lambda: func(key))
+        return wrapper
+    return decorator
+
+
+def invalidate_on_flush(model, entity: str) -> None:
+    """ Invalidate the entity when its ORM object is updated / deleted """
+    def _invalidate(mapper, connection, target):
+        entity_cache.invalidate(entity, target.id)
+    event.listen(model, 'after_update', _invalidate)
+    event.listen(model, 'after_delete', _invalidate)
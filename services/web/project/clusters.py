@@ -0,0 +1,137 @@
+import math
+from threading import Lock
+from typing import Dict, List, Tuple
+
+'''
+Precomputed map clusters of active book instances, per zoom level.
+
+For each zoom level 0..max_zoom the world (Web Mercator) is split into a grid
+of CELLS_PER_TILE x CELLS_PER_TILE cells per map tile. A cell keeps number of
+instances inside and sum of their coordinates, so a cluster is shown at the
+instances centroid. Adding / removing an instance updates one cell per zoom
+level, a tile is served by looking up its cells only, i.e. the cost doesn't
+depend on total number of listings.
+
+The index of a process is built from DB by a background job scheduled on its
+first tile request and then rebuilt every CLUSTERS_REBUILD_MINUTES (see
+utils.rebuild_clusters_job), never in a request: until it's built the tiles
+are empty. Processes which serve no tiles (CLI commands, idle workers) don't
+build it at all. It's updated incrementally by
+db_handlers when book instances are created, activated, deactivated or
+deleted, but the index is per process: other gunicorn workers see the
+changes after their next rebuild, i.e. up to CLUSTERS_REBUILD_MINUTES later.
+'''
+
+CELLS_PER_TILE = 4  # i.e. 64x64 px cells on 256x256 px tiles
+MAX_LATITUDE = 85.05112878  # Web Mercator limit
+
+
+def project(latitude: float, longitude: float) -> Tuple[float, float]:
+    """ Returns Web Mercator (x, y) of the point, both in [0, 1) """
+    latitude = max(min(latitude, MAX_LATITUDE), -MAX_LATITUDE)
+    x = (longitude + 180) / 360
+    sin_lat = math.sin(math.radians(latitude))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0), 0.999999999), min(max(y, 0), 0.999999999)
+
+
+class ClusterIndex:
+
+    def __init__(self, max_zoom: int = 14):
+        self.max_zoom = max_zoom
+        self.is_built = False
+        self.is_used = False  # a tile was requested, keep the index built
+        # {bi_id: (x, y, latitude, longitude)}
+        self._points: Dict[int, Tuple[float, float, float, float]] = dict()
+        # [{(cell_x, cell_y): [count, latitudes_sum, longitudes_sum]}, ...]
+        self._zooms: List[Dict[Tuple[int, int], list]] = [
+            dict() for _ in range(max_zoom + 1)]
+        self._lock = Lock()
+
+    def _update_cells(self, point, sign: int) -> None:
+        x, y, latitude, longitude = point
+        for zoom, cells in enumerate(self._zooms):
+            scale = (1 << zoom) * CELLS_PER_TILE
+            key = (int(x * scale), int(y * scale))
+            cell = cells.get(key)
+            if cell is None:
+                cell = cells[key] = [0, 0.0, 0.0]
+            cell[0] += sign
+            cell[1] += sign * latitude
+            cell[2] += sign * longitude
+            if cell[0] <= 0:
+                del cells[key]
+
+    def _add(self, bi_id: int, latitude, longitude) -> None:
+        self._remove(bi_id)
+        if latitude is None or longitude is None:
+            return
+        point = project(latitude, longitude) + (latitude, longitude)
+        self._points[bi_id] = point
+        self._update_cells(point, 1)
+
+    def _remove(self, bi_id: int) -> None:
+        point = self._points.pop(bi_id, None)
+        if point is not None:
+            self._update_cells(point, -1)
+
+    def add(self, bi_id: int, latitude: float, longitude: float) -> None:
+        """ Add (or move) active book instance """
+        with self._lock:
+            self._add(bi_id, latitude, longitude)
+
+    def remove(self, bi_id: int) -> None:
+        """ Remove deactivated / deleted book instance """
+        with self._lock:
+            self._remove(bi_id)
+
+    def use(self) -> bool:
+        """ Mark the index used, returns True the first time (the caller
+        schedules the build)
+        """
+        with self._lock:
+            first, self.is_used = not self.is_used, True
+            return first
+
+    def rebuild(self, locations) -> None:
+        """ Replace the index content.
+        Args:
+         - locations: iterable of (bi_id, latitude, longitude)
+        """
+        index = ClusterIndex(self.max_zoom)
+        for bi_id, latitude, longitude in locations:
+            index._add(bi_id, latitude, longitude)
+        with self._lock:
+            self._points, self._zooms = index._points, index._zooms
+            self.is_built = True
+
+    def tile(self, zoom: int, tile_x: int, tile_y: int) -> dict:
+        """ Returns clusters of the map tile as GeoJSON FeatureCollection.
+        Feature property 'n' is the number of book instances in the cluster.
+        """
+        features = []
+        if 0 <= zoom <= self.max_zoom:
+            cells = self._zooms[zoom]
+            for cell_x in range(tile_x * CELLS_PER_TILE,
+                                (tile_x + 1) * CELLS_PER_TILE):
+                for cell_y in range(tile_y * CELLS_PER_TILE,
+                                    (tile_y + 1) * CELLS_PER_TILE):
+                    cell = cells.get((cell_x, cell_y))
+                    if not cell:
+                        continue
+                    count, latitudes_sum, longitudes_sum = cell
+                    features.append({
+                        'type': 'Feature',
+                        'geometry': {
+                            'type': 'Point',
+                            'coordinates': [
+                                round(longitudes_sum / count, 6),
+                                round(latitudes_sum / count, 6),
+                            ],
+                        },
+                        'properties': {'n': count},
+                    })
+        return {'type': 'FeatureCollection', 'features': features}
+
+
+cluster_index = ClusterIndex()
@@ -3,26 +3,115 @@ import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 
+def _engine_options(uri: str, env_prefix: str = 'DB_') -> dict:
+    """ Engine pool options of the database, env_prefix + 'POOL_SIZE' etc.
+    env vars (the DB_* ones if not set). Pool size options are for
+    PostgreSQL etc., SQLite engines don't use a queue pool.
+    """
+    def _env(name, default):
+        return os.getenv(env_prefix + name, os.getenv('DB_' + name, default))
+
+    options = {
+        'pool_pre_ping': _env('POOL_PRE_PING', '1') == '1',
+        'pool_recycle': int(_env('POOL_RECYCLE', 1800)),  # seconds
+    }
+    if not uri.startswith('sqlite'):
+        options.update({
+            'pool_size': int(_env('POOL_SIZE', 5)),
+            'max_overflow': int(_env('MAX_OVERFLOW', 10)),
+            'pool_timeout': int(_env('POOL_TIMEOUT', 30)),  # seconds
+        })
+    return options
+
+
 class Config(object):
 
     FLASK_APP = os.getenv('FLASK_APP')
 
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL", "sqlite://")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Optional read replica for read-only db_handlers, see replica.py
+    SQLALCHEMY_BINDS = (
+        {'replica': os.getenv('REPLICA_DATABASE_URL')}
+        if os.getenv('REPLICA_DATABASE_URL') else {})
+    # Engine pools, DB_POOL_SIZE etc. env vars, REPLICA_DB_POOL_SIZE etc.
+    # for the replica (see _engine_options)
+    SQLALCHEMY_ENGINE_OPTIONS = _engine_options(SQLALCHEMY_DATABASE_URI)
+    SQLALCHEMY_REPLICA_ENGINE_OPTIONS = _engine_options(
+        os.getenv('REPLICA_DATABASE_URL', ''), 'REPLICA_DB_')
     SECRET_KEY = os.urandom(32)
 
+    # Entity cache settings (see cache.py), TTLs in seconds, 0 - no cache
+    ENTITY_CACHE_TTLS = {'user': 30, 'book': 300, 'book_instance': 60}
+    ENTITY_CACHE_MAX_BYTES = 16 * 1024 * 1024  # LRU eviction above it
+
     # Image upload settings
     MAX_IMAGE_FILESIZE = 2 * 1024 * 1024  # first multiplier = 1 Mb
     IMAGE_UPLOADS = os.path.join(basedir, 'static/covers')
     IMAGE_TARGET_SIZE = '110x160'  # i.e. width = 100 px, height = 160 px
     ALLOWED_IMAGE_EXTENSIONS = ["JPEG", "JPG", "PNG", "GIF"]
+    COVER_QUALITY = 85  # JPEG & WebP quality of the saved covers
+    # covers are made by a pool of processes, see cover_worker.py
+    COVER_WORKER_PROCESSES = int(os.getenv('COVER_WORKER_PROCESSES', 2))
+    COVER_QUEUE_SIZE = 32  # max covers queued, the next uploads are refused
+    COVER_RETRIES = 2
+    # smaller copies of the cover, <book_id>_<name>.jpg / .webp
+    COVER_VARIANTS = {
+        'm': '70x100',  # tiles, book page
+        's': '50x70',  # messages, map popups
+        'xs': '30x50',  # map markers
+    }
+    COVERS_MANIFEST_TTL = 60  # seconds, see utils.has_cover()
 
     # Map settings
     DEFAULT_MAP_COORDINADES = (50.4547, 30.520)  # Kyiv
+    MAP_CACHE_TTL = 60  # seconds, rendered maps are reused during the time
+    MAP_CACHE_SIZE = 256  # max number of rendered maps kept in memory
+    MAP_MARKERS_LIMIT = 5000  # max markers returned by /api/map_data
+    MAP_DATA_MAX_AGE = 60  # seconds, browsers may reuse /api/map_data
+    # full recalculation of map clusters, how stale other workers' clusters
+    # may be (see clusters.py)
+    CLUSTERS_REBUILD_MINUTES = 10
+    NEARBY_DEFAULT_RADIUS_KM = 5
+    NEARBY_MAX_RADIUS_KM = 100  # less where geo cells index can't cover it
+    NEARBY_RESULTS_LIMIT = 100
+
+    # Search settings
+    SEARCH_RESULTS_LIMIT = 100
+    AUTOCOMPLETE_RESULTS_LIMIT = 10
+    # 0..1, min trigram similarity of a misspelled word to a known one
+    SEARCH_SIMILARITY_THRESHOLD = 0.3
+    # PostgreSQL only, run 'manage.py create_trgm_index' first
+    SEARCH_USE_PG_TRGM = os.getenv('SEARCH_USE_PG_TRGM', '') == '1'
+
+    # Book page offers: sorting weights (see utils.rank_offers), page size
+    OFFERS_RANK_WEIGHTS = {'price': 1.0, 'condition': 0.5, 'distance': 1.0}
+    OFFERS_PER_PAGE = 20
+
+    # Home page library page size (keyset pagination, see get_library_page)
+    LIBRARY_PER_PAGE = 30
+    # Home page feed (FreshListing): only the newest listings are kept,
+    # the older ones are trimmed every FRESH_LISTINGS_TRIM_MINUTES
+    FRESH_LISTINGS_LIMIT = 1000
+    FRESH_LISTINGS_TRIM_MINUTES = 10
+
+    # Messages page size (keyset pagination, see get_messages_by_user)
+    MESSAGES_PER_PAGE = 50
+
+    # Admin analytics: cache TTL (seconds), count created rows from the
+    # daily rollup (DailyStats) instead of scanning old rows
+    ANALYTICS_CACHE_TTL = 60
+    ANALYTICS_USE_ROLLUP = os.getenv('ANALYTICS_USE_ROLLUP', '') == '1'
+
+    # User.last_seen write-behind buffer (see last_seen.py): flush period
+    # (seconds) and the buffer size which triggers the flush
+    LAST_SEEN_FLUSH_SECONDS = 60
+    LAST_SEEN_FLUSH_USERS = 1000
 
     # Other
     CHECK_EXPIRED_BOOK_INSTANCES = True
     EXPIRATION_PERIOD_DAYS = 30
+    EXPIRED_BI_CHUNK_SIZE = 1000  # rows per transaction of the expiry job
     NEW_BOOKS_PER_DAY_LIMIT = 3
 
     # Google OAUth2 credentials
@@ -0,0 +1,204 @@
+import atexit
+import io
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import Lock
+from typing import Union
+
+
+from . import app
+from .thumbs import make_cover
+from .utils import add_to_covers_manifest, cover_upload
+
+'''
+Cover uploads are processed off the request path.
+
+The request reads the upload and enqueues it: a pool of COVER_WORKER_PROCESSES
+processes decodes, crops and saves the cover with its variants (see
+thumbs.make_cover), so the request takes the same time whatever the image
+size is. Until the cover is saved the book shows the default one.
+
+ - backpressure: at most COVER_QUEUE_SIZE covers are queued / in work, the
+   next upload is refused (the user is asked to try again later)
+ - retries: a cover is resubmitted COVER_RETRIES times if its pool process
+   died or the pool was shut down / replaced meanwhile. Errors of the cover
+   itself (not an image, truncated, too big, can't be saved) are final:
+   the same bytes would fail the same way.
+ - status: /api/covers/<book_id>, see CoverWorker.status()
+
+COVER_WORKER_PROCESSES = 0 processes the covers in the request, as before.
+The queue is per web process (gunicorn worker), status of a cover queued by
+another worker is told by its file.
+
+The pool processes are forked on the first upload of the web process, so
+CLI commands (manage.py, flask db) start none. They only run
+thumbs.make_cover, which takes no lock shared with the app threads (logging,
+DB), so it's safe to fork from the threaded worker; the processes would
+import the whole app with spawn / forkserver context.
+A pool broken by a died process is replaced by a new one.
+'''
+
+QUEUED = 'queued'
+DONE = 'done'
+FAILED = 'failed'
+BUSY = 'busy'  # the queue is full
+
+
+class CoverWorker:
+
+    def __init__(self, processes: int = 2, queue_size: int = 32,
+                 retries: int = 2, keep_statuses: int = 1000):
+        self.processes = processes
+        self.queue_size = queue_size
+        self.retries = retries
+        self.keep_statuses = keep_statuses
+        self._executor = None
+        self._executor_pid = None  # the process which started the pool
+        # {book_id: {'status', 'attempts', 'error'}}, finished ones are kept
+        # for the status requests, keep_statuses at most
+        self._jobs = OrderedDict()
+        self._pending = 0
+        self._closed = False  # shut down, no new pools
+        self._lock = Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('cover worker is shut down')
+            # a pool started by the parent (e.g. gunicorn --preload) can't
+            # be used by a forked process
+            if self._executor is None or self._executor_pid != os.getpid():
+                # fork: the processes don't import the app again
+                executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('fork'))
+                # fork all the processes right away
+                for future in [executor.submit(os.getpid)
+                               for _ in range(self.processes)]:
+                    future.result()
+                self._executor = executor
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _drop_executor(self, executor: ProcessPoolExecutor) -> None:
+        """ Shut the broken pool down, the next cover starts a new one """
+        with self._lock:
+            if self._executor is not executor:
+                return  # dropped already
+            self._executor = None
+        executor.shutdown(wait=False)
+
+    def upload(self, cover, book_id) -> str:
+        """ Make the book cover of the uploaded file (FileStorage): enqueue
+        it or, if there are no worker processes, make it right away.
+        Returns QUEUED, BUSY (try later), DONE or FAILED (not an image).
+        """
+        if not self.processes:
+            return FAILED if cover_upload(cover, book_id) else DONE
+        data = getattr(cover, 'stream', cover).read()
+        return QUEUED if self.submit(book_id, data) else BUSY
+
+    def submit(self, book_id: int, data: bytes) -> bool:
+        """ Enqueue the uploaded image as the book cover.
+        Returns False if the queue is full or the book cover is in work
+        already.
+        """
+        book_id = int(book_id)
+        with self._lock:
+            job = self._jobs.get(book_id)
+            if self._pending >= self.queue_size or (
+                    job and job['status'] == QUEUED):
+                return False
+            self._pending += 1
+            self._jobs[book_id] = {'status': QUEUED, 'attempts': 0,
+                                   'error': None}
+            self._jobs.move_to_end(book_id)
+        self._run(book_id, data)
+        return True
+
+    def _run(self, book_id: int, data: bytes) -> None:
+        with self._lock:
+            self._jobs[book_id]['attempts'] += 1
+        executor = None
+        try:
+            executor = self._get_executor()
+            future = executor.submit(
+                make_cover,
+                io.BytesIO(data),
+                app.config['IMAGE_UPLOADS'],
+                book_id,
+                app.config['IMAGE_TARGET_SIZE'],
+                app.config['COVER_VARIANTS'],
+                app.config['COVER_QUALITY'],
+            )
+        # BrokenProcessPool: a process died, RuntimeError: the pool was shut
+        # down by another thread (replaced / at exit)
+        except (BrokenProcessPool, RuntimeError) as e:
+            self._finish(book_id, data, executor, e, retry=True)
+            return
+        future.add_done_callback(lambda future: self._finish(
+            book_id, data, executor, future.exception(),
+            retry=isinstance(future.exception(), BrokenProcessPool)))
+
+    def _finish(self, book_id: int, data: bytes,
+                executor: Union[ProcessPoolExecutor, None],
+                error: Union[BaseException, None],
+                retry: bool = False) -> None:
+        """ Mark the cover done / failed, or retry it if the error is
+        of the pool, not of the cover (retry=True)
+        """
+        if error is None:
+            with app.app_context():
+                add_to_covers_manifest(book_id)
+            self._set_status(book_id, DONE, None)
+            return
+        if retry and executor is not None:
+            self._drop_executor(executor)
+        with self._lock:
+            attempts = self._jobs[book_id]['attempts']
+        if retry and attempts <= self.retries:
+            app.logger.warning(f'Cover {book_id} failed, retry: {error!r}')
+            self._run(book_id, data)
+            return
+        app.logger.error(f'Cover {book_id} failed: {error!r}')
+        self._set_status(book_id, FAILED, repr(error))
+
+    def _set_status(self, book_id: int, status: str, error) -> None:
+        with self._lock:
+            self._jobs[book_id].update(status=status, error=error)
+            self._pending -= 1
+            finished = [key for key, job in self._jobs.items()
+                        if job['status'] != QUEUED]
+            for key in finished[:max(0, len(finished) - self.keep_statuses)]:
+                del self._jobs[key]
+
+    def status(self, book_id: int) -> Union[dict, None]:
+        """ Returns {'status': queued / done / failed, 'attempts', 'error'}
+        of the cover uploaded to this process, None if it's unknown here
+        """
+        with self._lock:
+            job = self._jobs.get(int(book_id))
+            return dict(job) if job else None
+
+    def pending(self) -> int:
+        """ Number of the covers queued / in work """
+        with self._lock:
+            return self._pending
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            self._closed = True
+            executor, self._executor = self._executor, None
+        if executor is not None and self._executor_pid == os.getpid():
+            executor.shutdown(wait=wait)
+
+
+cover_worker = CoverWorker(
+    processes=app.config['COVER_WORKER_PROCESSES'],
+    queue_size=app.config['COVER_QUEUE_SIZE'],
+    retries=app.config['COVER_RETRIES'],
+)
+atexit.register(cover_worker.shutdown)  # finish the queued covers
@@ -1,15 +1,26 @@
-import csv
+import heapq
 import os
 from datetime import datetime, timedelta
-from random import randint, random
-from typing import List, Union
+from typing import List, Tuple, Union
 from shutil import copyfile, rmtree
 
 
-from sqlalchemy import and_, desc, or_
+from flask import current_app
+from sqlalchemy import and_, case, desc, func, literal, or_, true, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
 
 from . import db
-from .models import Book, BookInstance, Message, User
+from .cache import cached, entity_cache
+from .clusters import cluster_index
+from .geo import bbox_around, cell_id, cells_in_bbox, haversine
+from .isbn import canonical_isbn
+from .models import (FRESH_LISTING_COLUMNS, Book, BookInstance, DailyStats,
+                     FreshListing, Message, User, fresh_listings_select,
+                     sync_fresh_listings)
+from .replica import read_only
+from .search import book_index
+from .seed import generate as seed_generate
 
 
 #  ------------  GENERAL DB ------------------
@@ -18,59 +29,42 @@ def make_db_data(
         # filepath='project/test_books_data.csv',
         filepath='project/data_example/example_data.csv',
         users=15,
-        books=15,  # data example is prepared for 15 books only
+        books=15,
         book_instances=60,
         latitude=50.4547,
-        longitude=30.520) -> None:
-    """ Fill DB with Users, Books, BookInstances
+        longitude=30.520,
+        messages=0,
+        batch_size=10000,
+        seed=None) -> None:
+    """ Fill DB with Users, Books, BookInstances, Messages
     Args:
      - filepath:str filepath to *.csv file to parse to fill db with the data
-     - users , books, book_instances, : how many fake to genetate.
-       Keep in mind - only 15 book covers are prepared. Better not to change
-       'books=15' with no real need.
+       (the first books), the rest of the books are synthetic.
+     - users , books, book_instances, messages: how many fake to genetate.
+       Keep in mind - only 15 book covers are prepared, other books are
+       shown with the default cover.
       - latitude, longitude - basic coordinates. Users location is generated
-        around this point.
+        around this point (and a few other cities).
+     - batch_size: rows per bulk insert
+     - seed: random seed to reproduce the same data
+    See seed.generate() for the details.
     """
 
     if not os.path.exists(filepath):
         return
 
-    # create users
-    for i in range(users):
-        user = User(
-            username='user_' + str(i),
-            email='user_' + str(i) + '@gmail.com',
-            latitude=latitude + (random() - 0.5) / 3,
-            longitude=longitude + (random() - 0.5) / 3,
-            about_me='No info about the user yet.'
-        )
-        db.session.add(user)
-    db.session.commit()
-
-    # import books from file & write them into db
-    if os.path.exists(filepath):
-        with open(filepath, newline='') as csvfile:
-            book_reader = csv.reader(csvfile, delimiter=',', quotechar="'")
-            for title, author, isbn_13 in book_reader:
-                db.session.add(Book(
-                    title=title,
-                    author=author,
-                    isbn_13=isbn_13))
-            db.session.commit()
-
-    # create boook instances
-    for book_instance in range(book_instances):
-        book_id = randint(1, books)
-        book_instance = BookInstance(
-            book_id=book_id,
-            owner_id=randint(1, users),
-            price=randint(20, 200),
-            condition=randint(1, 4),
-            description='Lorem ipsum...',
-        )
-        incr_instance_counter(book_id)
-        db.session.add(book_instance)
-    db.session.commit()
+    seed_generate(
+        users=users,
+        books=books,
+        book_instances=book_instances,
+        messages=messages,
+        batch_size=batch_size,
+        seed=seed,
+        latitude=latitude,
+        longitude=longitude,
+        filepath=filepath,
+    )
+    rebuild_fresh_listings()
 
     # copy covers to static/covers
     for i in range(16):
@@ -93,48 +87,181 @@ def delete_all_files_in_dir(folder: str):
 
 #  ------------  COMMON ------------------
 
-def obj_counter(_class, days: int = 0) -> int:
-    ''' Returns quantity of the class objects created during last X days.
-    if days == 0 --> count all objects.
-    '''
-    if days:
-        time_from = (datetime.today() - timedelta(days))
-        return _class.query.filter(_class.timestamp > time_from).count()
-    return _class.query.count()
+def _count_if(criterion):
+    """ COUNT(CASE WHEN criterion THEN 1 END) """
+    return func.count(case([(criterion, 1)]))
 
 
-#  ------------  BOOK ------------------
+@read_only
+def get_analytics(windows=(1, 7, 30), use_rollup: bool = False) -> dict:
+    """ Returns admin dashboard numbers:
+    {window: {'users', 'active_users', 'books', 'book_instances',
+    'active_book_instances'}}, windows are days, 0 - all time.
 
-def get_books_by_kw(key_word) -> List[Book]:
-    """ Returns list of book instances founded by key_words
-
-    Q: why is the loop?
-    A: to decrease key_words untill something is found.
-    The crutch solves next problem:
-    if request contained part of Author and part of book_title returns None
-    for example 'Hamlet William' --> None
-    It's simple, stupid, yes. Later going to made a search with Elastic
-    Current problem: ' rssr Hamlet William' --> None because 'rssr' still not
-    found. Split key_word to words and use these words combinations looks
-    like a nightmare.
+    One aggregated query per table: all windows are conditional counts of
+    the same scan. With use_rollup the numbers of created users / books /
+    book instances are taken from DailyStats for the finished days (windows
+    are calendar days then), only today's rows are counted live.
     """
+    now = datetime.utcnow()
+    today = datetime.combine(now.date(), datetime.min.time())
+    since = {days: now - timedelta(days) for days in windows}
+    stats = {days: dict() for days in (0,) + tuple(windows)}
+
+    def created_criteria(model) -> list:
+        if use_rollup:
+            return [model.timestamp >= today]
+        return [model.timestamp > since[days] for days in windows]
+
+    users = db.session.query(
+        func.count(User.id),
+        *[_count_if(User.last_seen > since[days]) for days in windows],
+        *[_count_if(c) for c in created_criteria(User)]).one()
+    books = db.session.query(
+        func.count(Book.id),
+        *[_count_if(c) for c in created_criteria(Book)]).one()
+    book_instances = db.session.query(
+        func.count(BookInstance.id),
+        _count_if(BookInstance.is_active == true()),
+        *[_count_if(and_(BookInstance.is_active == true(),
+                         BookInstance.timestamp > since[days]))
+          for days in windows],
+        *[_count_if(c) for c in created_criteria(BookInstance)]).one()
+
+    stats[0]['users'] = stats[0]['active_users'] = users[0]
+    stats[0]['books'] = books[0]
+    stats[0]['book_instances'] = book_instances[0]
+    stats[0]['active_book_instances'] = book_instances[1]
+    for i, days in enumerate(windows):
+        stats[days]['active_users'] = users[1 + i]
+        stats[days]['active_book_instances'] = book_instances[2 + i]
+
+    created = {
+        'users': users[1 + len(windows):],
+        'books': books[1:],
+        'book_instances': book_instances[2 + len(windows):],
+    }
+    if not use_rollup:
+        for name, counts in created.items():
+            for days, count in zip(windows, counts):
+                stats[days][name] = count
+        return stats
+
+    # today's rows + DailyStats of the previous (days - 1) days
+    rollup = db.session.query(*[
+        func.coalesce(func.sum(case(
+            [(DailyStats.day >= (today - timedelta(days - 1)).date(),
+              getattr(DailyStats, name))], else_=0)), 0)
+        for days in windows for name in created]).one()
+    for i, days in enumerate(windows):
+        for j, (name, counts) in enumerate(created.items()):
+            stats[days][name] = counts[0] + rollup[i * len(created) + j]
+    return stats
+
+
+def rollup_daily_stats(backfill_days: int = 30) -> int:
+    """ Writes DailyStats of the finished days which are not rolled up yet
+    (backfill_days days back for the empty table).
+    Returns number of the days written.
+    """
+    today = datetime.utcnow().date()
+    last_day = db.session.query(func.max(DailyStats.day)).scalar()
+    day = (last_day + timedelta(1) if last_day
+           else today - timedelta(backfill_days))
+    days = 0
+    while day < today:
+        start = datetime.combine(day, datetime.min.time())
+        end = start + timedelta(1)
+
+        def created(model) -> int:
+            return (db.session.query(func.count(model.id))
+                    .filter(model.timestamp >= start, model.timestamp < end)
+                    .scalar())
+
+        db.session.add(DailyStats(
+            day=day,
+            users=created(User),
+            books=created(Book),
+            book_instances=created(BookInstance),
+        ))
+        day += timedelta(1)
+        days += 1
+    try:
+        db.session.commit()
+    except IntegrityError:  # rolled up by another worker
+        db.session.rollback()
+        return 0
+    return days
 
-    search = "%{}%".format(key_word)
-
-    def search_attempt(search):
-        books_by_title = Book.query.filter(Book.title.like(search)).all()
-        if not books_by_title:
-            books_by_author = Book.query.filter(Book.author.like(search)).all()
-            return books_by_author
-        return books_by_title
 
-    search_result = search_attempt(search)
+#  ------------  BOOK ------------------
 
-    while ' ' in search and not search_result:
-        search = search.rsplit(' ', 1)[0] + '%'
-        search_result = search_attempt(search)
+@read_only
+def get_books_by_kw(
+        key_word,
+        limit: int = 100,
+        threshold: float = 0.3) -> List[Book]:
+    """ Returns list of books found by key_words, most relevant go first.
 
-    return search_result
+    Any subset of the key words gives a match, i.e. both 'Hamlet William'
+    and ' rssr Hamlet William' find Hamlet. Misspelled words are matched by
+    trigram similarity >= threshold. See search.SearchIndex.
+    """
+    if (current_app.config['SEARCH_USE_PG_TRGM']
+            and db.engine.dialect.name == 'postgresql'):
+        return get_books_by_kw_pg_trgm(key_word, limit, threshold)
+
+    books_ids = book_index.search(key_word, limit, threshold)
+    if not books_ids:
+        return []
+    books = Book.query.filter(Book.id.in_(books_ids)).all()
+    if len(books) < len(books_ids):  # deleted
+        book_index.purge(set(books_ids) - {book.id for book in books})
+    rank = {book_id: i for i, book_id in enumerate(books_ids)}
+    return sorted(books, key=lambda book: rank[book.id])
+
+
+@read_only
+def get_books_suggestions(key_word, limit: int = 10) -> List[Book]:
+    """ Returns list of (id, title, author, instance_counter) for
+    search-as-you-type. The last word of key_word is treated as a prefix.
+    """
+    books_ids = book_index.suggest(key_word, limit)
+    if not books_ids:
+        return []
+    books = (db.session.query(
+        Book.id,
+        Book.title,
+        Book.author,
+        Book.instance_counter)
+        .filter(Book.id.in_(books_ids))
+        .all())
+    if len(books) < len(books_ids):  # deleted
+        book_index.purge(set(books_ids) - {book.id for book in books})
+    rank = {book_id: i for i, book_id in enumerate(books_ids)}
+    return sorted(books, key=lambda book: rank[book.id])
+
+
+def get_books_by_kw_pg_trgm(
+        key_word,
+        limit: int = 100,
+        threshold: float = 0.3) -> List[Book]:
+    """ Same as get_books_by_kw, but uses PostgreSQL pg_trgm extension.
+    '<%' operator is served by GIN indexes (see manage.py create_trgm_index)
+    """
+    db.session.execute(
+        "SELECT set_config('pg_trgm.word_similarity_threshold', :t, true)",
+        {'t': str(threshold)})
+    similarity = func.greatest(
+        func.word_similarity(key_word, Book.title),
+        func.word_similarity(key_word, Book.author))
+    books = (Book.query
+             .filter(or_(literal(key_word).op('<%')(Book.title),
+                         literal(key_word).op('<%')(Book.author)))
+             .order_by(desc(similarity), Book.id)
+             .limit(limit)
+             .all())
+    return books
 
 
 def create_book(title: str,
@@ -143,15 +270,28 @@ def create_book(title: str,
                 isbn_13: Union[str, None],
                 current_user_id: int,
                 ) -> Book:
+    """ Add book to db. Returns the new book or the existing one with the
+    same ISBN (e.g. created by another user at the same moment).
+    """
+    isbn = canonical_isbn(isbn_13) or canonical_isbn(isbn_10)
     book = Book(
         title=title,
         author=author,
+        isbn=isbn,
         isbn_10=isbn_10,
         isbn_13=isbn_13,
         created_by=current_user_id,
     )
     db.session.add(book)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError:  # ix_book_isbn is unique
+        db.session.rollback()
+        existing = get_book_by_isbn(isbn) if isbn else None
+        if existing is None:
+            raise  # not an ISBN duplicate
+        return existing
+    book_index.sync()
     return book
 
 
@@ -179,68 +319,106 @@ def get_books_by_user_id(user_id) -> List[Book]:
     return books
 
 
-def get_book(book_id) -> Union[Book, None]:
-    book = Book.query.filter_by(
-        id=book_id).first()
-    return book
+@read_only
+def get_library_page(
+        after: Union[int, None] = None,
+        limit: int = 30) -> Tuple[List[Book], Union[int, None]]:
+    """ Returns page of the library (the newest books first) and cursor of
+    the next page or None if it's the last one.
+    Args:
+     - after: cursor (book id), only books after it are returned
+     - limit: page size
+
+    Keyset pagination over the primary key: the cost of a page doesn't
+    depend on the page number or library size. Book id never changes, so
+    the pages don't skip or repeat books whatever is sold meanwhile.
+    """
+    query = Book.query
+    if after is not None:
+        query = query.filter(Book.id < after)
+    books = query.order_by(Book.id.desc()).limit(limit + 1).all()
+    if len(books) <= limit:
+        return books, None
+    books = books[:limit]
+    return books, books[-1].id
 
 
-def get_book_by_isbn_10(isbn_10) -> Union[Book, None]:
+@cached('book')
+def get_book(book_id) -> Union[Book, None]:
     book = Book.query.filter_by(
-        isbn_10=isbn_10).first()
+        id=book_id).first()
     return book
 
 
-def get_book_by_isbn_13(isbn_13) -> Union[Book, None]:
-    book = Book.query.filter_by(
-        isbn_13=isbn_13).first()
-    return book
+def get_book_by_isbn(isbn) -> Union[Book, None]:
+    """ Returns the book by ISBN-10 or ISBN-13 (str or int) """
+    isbn = canonical_isbn(isbn)
+    if isbn is None:
+        return None
+    return Book.query.filter_by(isbn=isbn).first()
 
 
 def update_book_isbn_10(book_id, isbn_10) -> Union[Book, None]:
+    """ Set isbn_10, and the canonical isbn if the book has no ISBN yet """
     book = (
         db.session.query(Book)
         .filter(Book.id == book_id)
         .update(
             {
                 Book.isbn_10: isbn_10,
+                Book.isbn: func.coalesce(Book.isbn, canonical_isbn(isbn_10)),
             }, synchronize_session=False))
     db.session.commit()
+    entity_cache.invalidate('book', int(book_id))
+    entity_cache.invalidate('book_instance')  # the rows have book's ISBNs
     return book
 
 
 def update_book_isbn_13(
         book_id,
         isbn_13) -> Union[Book, None]:
+    """ Set isbn_13, and the canonical isbn if the book has no ISBN yet """
     book = (
         db.session.query(Book)
         .filter(Book.id == book_id)
         .update(
             {
                 Book.isbn_13: isbn_13,
+                Book.isbn: func.coalesce(Book.isbn, canonical_isbn(isbn_13)),
             }, synchronize_session=False))
     db.session.commit()
+    entity_cache.invalidate('book', int(book_id))
+    entity_cache.invalidate('book_instance')  # the rows have book's ISBNs
     return book
 
 
-def incr_instance_counter(book_id) -> Union[int, None]:
-    """ Icrement book.instance_counter by 1.
-    Return new value (int)"""
-    book = Book.query.filter_by(id=book_id).first()
-    if book:
-        book.instance_counter += 1
-        db.session.commit()
-        return book.instance_counter
+def incr_instance_counter(book_id) -> int:
+    """ Increment book.instance_counter by 1 in the current transaction
+    (UPDATE ... SET instance_counter = instance_counter + 1, no lost updates).
+    The caller commits. Returns number of updated rows (0 if no such book).
+    """
+    return (Book.query
+            .filter(Book.id == book_id)
+            .update({Book.instance_counter: Book.instance_counter + 1},
+                    synchronize_session=False))
 
 
 def decr_instance_counter(book_id) -> int:
-    """ Decrement book.instance_counter by 1. Return new value (int)"""
-    book = Book.query.filter_by(id=book_id).first()
-    if book.instance_counter > 0:
-        book.instance_counter -= 1
-        db.session.commit()
-        return book.instance_counter
-    raise ValueError(f'instance_counter Value error for book_id={book_id}')
+    """ Decrement book.instance_counter by 1 in the current transaction.
+    The caller commits. Returns number of updated rows.
+    If there is no such book or its counter is 0 already the whole
+    transaction (e.g. the instance delete) is rolled back and ValueError
+    is raised.
+    """
+    updated = (Book.query
+               .filter(Book.id == book_id, Book.instance_counter > 0)
+               .update({Book.instance_counter: Book.instance_counter - 1},
+                       synchronize_session=False))
+    if not updated:
+        db.session.rollback()
+        raise ValueError(
+            f'instance_counter Value error for book_id={book_id}')
+    return updated
 
 
 def book_counter_created_by_user(
@@ -274,26 +452,185 @@ def get_all_book_instances() -> List[BookInstance]:
     return book_instances
 
 
-def get_freshest_book_instances(items: int) -> List[BookInstance]:
-    """ Returns n freshest BookInstances """
+@read_only
+def get_freshest_book_instances(items: int) -> List[FreshListing]:
+    """ Returns n freshest active BookInstances (FreshListing rows) """
+    return (FreshListing.query
+            .order_by(FreshListing.timestamp.desc(), FreshListing.id.desc())
+            .limit(items)
+            .all())
+
+
+def _sync_fresh_listings(criterion) -> None:
+    """ Rewrite the feed rows of the book instances matched criterion in
+    the current transaction: bulk UPDATEs don't fire the mapper events
+    (see models.FreshListing). The caller commits.
+    """
+    sync_fresh_listings(db.session.connection(), criterion)
+
+
+def rebuild_fresh_listings(limit: int = None) -> int:
+    """ Refill the home page feed from the newest `limit` book instances
+    (FRESH_LISTINGS_LIMIT by default), e.g. after seeding DB or editing it
+    in the admin panel. Returns number of listings.
+    """
+    if limit is None:
+        limit = current_app.config['FRESH_LISTINGS_LIMIT']
+    FreshListing.query.delete(synchronize_session=False)
+    newest = (fresh_listings_select(true())
+              .order_by(BookInstance.timestamp.desc(), BookInstance.id.desc())
+              .limit(limit))
+    db.session.execute(FreshListing.__table__.insert().from_select(
+        FRESH_LISTING_COLUMNS, newest))
+    db.session.commit()
+    return FreshListing.query.count()
+
+
+def trim_fresh_listings(limit: int = None) -> int:
+    """ Keep the newest `limit` listings of the home page feed
+    (FRESH_LISTINGS_LIMIT by default), returns number of removed ones.
+    """
+    if limit is None:
+        limit = current_app.config['FRESH_LISTINGS_LIMIT']
+    boundary = (db.session.query(FreshListing.timestamp, FreshListing.id)
+                .order_by(FreshListing.timestamp.desc(),
+                          FreshListing.id.desc())
+                .offset(limit)
+                .first())
+    if boundary is None:
+        return 0
+    removed = (FreshListing.query
+               .filter(or_(FreshListing.timestamp < boundary.timestamp,
+                           and_(FreshListing.timestamp == boundary.timestamp,
+                                FreshListing.id <= boundary.id)))
+               .delete(synchronize_session=False))
+    db.session.commit()
+    return removed
+
+
+@read_only
+def get_active_bi_locations(
+        book_ids: Union[List[int], None] = None,
+        bbox: Union[tuple, None] = None,
+        limit: int = 5000) -> List[BookInstance]:
+    """ Returns active BookInstances with their Book title and owners
+    coordinates.
+    Args:
+     - book_ids - only instances of the books, all books if None
+     - bbox - (min_lon, min_lat, max_lon, max_lat) only instances inside
+    """
+    if book_ids is not None and not book_ids:
+        return []
     book_instances = (db.session.query(
-        User.username,
+        BookInstance.id,
+        BookInstance.book_id,
+        BookInstance.price,
         User.latitude,
         User.longitude,
-        BookInstance.book_id,
-        Book.title,
-        Book.author,
-        Book.isbn_10,
-        Book.isbn_13,
+        Book.title)
+        .filter(BookInstance.owner_id == User.id)
+        .filter(BookInstance.book_id == Book.id)
+        .filter(BookInstance.is_active == true()))
+    if book_ids is not None:
+        book_instances = book_instances.filter(
+            BookInstance.book_id.in_(book_ids))
+    if bbox is not None:
+        book_instances = _filter_users_in_bbox(book_instances, bbox)
+    return book_instances.order_by(BookInstance.id).limit(limit).all()
+
+
+def _filter_users_in_bbox(query, bbox: tuple):
+    """ Filter the query by User location inside
+    bbox = (min_lon, min_lat, max_lon, max_lat).
+    Uses User.geo_cell index when the bbox covers not too many cells.
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    cells = cells_in_bbox(bbox)
+    if cells is not None:
+        query = query.filter(User.geo_cell.in_(cells))
+    return (query
+            .filter(User.latitude.between(min_lat, max_lat))
+            .filter(User.longitude.between(min_lon, max_lon)))
+
+
+def _sync_clusters(criterion) -> None:
+    """ Update map clusters with the book instances matched criterion
+    (if the clusters are in use in the process)
+    """
+    if not cluster_index.is_built:
+        return
+    book_instances = (db.session.query(
+        BookInstance.id,
+        BookInstance.is_active,
+        User.latitude,
+        User.longitude)
+        .filter(BookInstance.owner_id == User.id)
+        .filter(criterion))
+    for bi_id, is_active, latitude, longitude in book_instances:
+        if is_active:
+            cluster_index.add(bi_id, latitude, longitude)
+        else:
+            cluster_index.remove(bi_id)
+
+
+def rebuild_clusters() -> None:
+    """ Recalculate map clusters of all active book instances """
+    book_instances = (db.session.query(
+        BookInstance.id,
+        User.latitude,
+        User.longitude)
+        .filter(BookInstance.owner_id == User.id)
+        .filter(BookInstance.is_active == true())
+        .yield_per(10000))
+    cluster_index.rebuild(book_instances)
+
+
+@read_only
+def get_active_bi_nearby(
+        latitude: float,
+        longitude: float,
+        radius_km: float,
+        limit: int = 100) -> List[dict]:
+    """ Returns active BookInstances (with Book title & author) offered
+    within radius_km from the point, the nearest go first.
+    Each item has additional 'distance' key (km).
+    """
+    book_instances = (db.session.query(
         BookInstance.id,
+        BookInstance.book_id,
         BookInstance.price,
         BookInstance.condition,
-        BookInstance.description,
-        BookInstance.timestamp)
+        Book.title,
+        Book.author,
+        User.username,
+        User.latitude,
+        User.longitude)
         .filter(BookInstance.owner_id == User.id)
         .filter(BookInstance.book_id == Book.id)
-        .order_by(desc(BookInstance.timestamp)).limit(items).all())
-    return book_instances
+        .filter(BookInstance.is_active == true()))
+    book_instances = _filter_users_in_bbox(
+        book_instances, bbox_around(latitude, longitude, radius_km))
+
+    nearby = []
+    for bi in book_instances:
+        distance = haversine(latitude, longitude, bi.latitude, bi.longitude)
+        if distance <= radius_km:
+            nearby.append(dict(bi._asdict(), distance=distance))
+    return heapq.nsmallest(limit, nearby, key=lambda x: x['distance'])
+
+
+def update_users_geo_cells() -> int:
+    """ Fill User.geo_cell for the users which have no it yet.
+    Returns number of updated users.
+    """
+    users = (User.query
+             .filter(User.geo_cell.is_(None))
+             .filter(User.latitude.isnot(None))
+             .all())
+    for user in users:
+        user.geo_cell = cell_id(user.latitude, user.longitude)
+    db.session.commit()
+    return len(users)
 
 
 def create_book_instance(
@@ -314,9 +651,11 @@ def create_book_instance(
         price=price,
         condition=condition,
         description=description)
-    db.session.add(book_instance)
+    db.session.add(book_instance)  # its feed row: models.FreshListing
     incr_instance_counter(book_id)
     db.session.commit()
+    entity_cache.invalidate('book', int(book_id))
+    _sync_clusters(BookInstance.id == book_instance.id)
     return book_instance
 
 
@@ -325,7 +664,8 @@ def update_book_instance(
         price,
         condition,
         description) -> BookInstance:
-    bi_prev_state = get_book_instance_by_id(book_instance_id)
+    # from DB: a stale cached row could make the update skipped
+    bi_prev_state = get_book_instance_by_id.__wrapped__(book_instance_id)
     if (
         price != bi_prev_state.price
         or condition != bi_prev_state.condition
@@ -340,18 +680,37 @@ def update_book_instance(
                     BookInstance.condition: condition,
                     BookInstance.description: description
                 }, synchronize_session=False))
+        _sync_fresh_listings(BookInstance.id == book_instance_id)
         db.session.commit()
+        entity_cache.invalidate('book_instance', int(book_instance_id))
         return bi
     return bi_prev_state
 
 
 def delete_book_instance(book_instance_id: str) -> None:
-    bi = get_book_instance_by_id(book_instance_id)
-    decr_instance_counter(bi.book_id)
-    BookInstance.query.filter_by(id=book_instance_id).delete()
+    """ Delete book instance and decrement its book counter in one
+    transaction. The counter is decremented only if this call has deleted
+    the row, so concurrent deletes of the same instance count once.
+    """
+    book_id = (db.session.query(BookInstance.book_id)
+               .filter(BookInstance.id == book_instance_id)
+               .scalar())
+    (FreshListing.query
+     .filter(FreshListing.id == book_instance_id)
+     .delete(synchronize_session=False))
+    deleted = (BookInstance.query
+               .filter(BookInstance.id == book_instance_id)
+               .delete(synchronize_session=False))
+    if deleted:
+        decr_instance_counter(book_id)
     db.session.commit()
+    entity_cache.invalidate('book_instance', int(book_instance_id))
+    if deleted:
+        entity_cache.invalidate('book', book_id)
+    cluster_index.remove(int(book_instance_id))
 
 
+@cached('book_instance')
 def get_book_instance_by_id(
         book_instance_id: str) -> Union[BookInstance, None]:
     """ Returns BookInstance object if exists in DB or None"""
@@ -375,6 +734,17 @@ def get_book_instance_by_id(
     return book_instance
 
 
+def get_book_instance_owner_id(book_instance_id) -> int:
+    """ Returns owner id of the book instance (404 if there is no such one).
+    Read from DB, not cached: it's used for the permission checks.
+    """
+    return (db.session.query(BookInstance.owner_id)
+            .filter(BookInstance.id == book_instance_id)
+            .first_or_404()
+            .owner_id)
+
+
+@read_only
 def get_book_instances_by_user_id(user_id) -> List[BookInstance]:
     """ Returns list of BookInstance objects """
     book_instances = (db.session.query(
@@ -397,8 +767,9 @@ def get_book_instances_by_user_id(user_id) -> List[BookInstance]:
     return book_instances
 
 
+@read_only
 def get_book_instances_by_book_id(book_id) -> List[BookInstance]:
-    """ Returns list of BookInstance objects """
+    """ Returns list of active BookInstance objects (offers) """
     book_instances = (db.session.query(
         User.username,
         User.id,
@@ -407,8 +778,11 @@ def get_book_instances_by_book_id(book_id) -> List[BookInstance]:
         BookInstance.price,
         BookInstance.condition,
         BookInstance.description,
-        BookInstance.is_active)
+        BookInstance.is_active,
+        User.latitude,
+        User.longitude)
         .filter(BookInstance.book_id == book_id)
+        .filter(BookInstance.is_active == true())
         .filter(BookInstance.owner_id == User.id)
         .order_by(BookInstance.id.desc())
         .all())
@@ -425,39 +799,52 @@ def get_book_instances_id_by_book_id(book_id) -> tuple:
     return book_instances_ids
 
 
-def get_expired_bi_with_users(expiration_period_days=30) -> List[BookInstance]:
-    """ Returns user_email and bi_id & title & author for
-    expired bi only."""
-    expiration_time = datetime.today() - timedelta(days=expiration_period_days)
-    expiration_time_timestamp = datetime.timestamp(expiration_time)
-
-    book_instances = (db.session.query(
+def get_expired_bi_chunk(
+        expiration_time: datetime,
+        after: Union[Tuple[int, int], None] = None,
+        limit: int = 1000) -> list:
+    """ Returns chunk of active book instances created before
+    expiration_time: rows (owner_id, email, id, title, author) ordered by
+    (owner_id, id), i.e. instances of an owner go together.
+    Args:
+     - after: cursor (owner_id, id) of the last row of the previous chunk
+     - limit: chunk size
+    """
+    query = (db.session.query(
+        BookInstance.owner_id,
         User.email,
         BookInstance.id,
         Book.title,
         Book.author,
     )
         .filter(BookInstance.book_id == Book.id)
-        .filter(BookInstance.is_active is True)
-        .filter(BookInstance.timestamp <= expiration_time_timestamp)
         .filter(BookInstance.owner_id == User.id)
-        .order_by(BookInstance.id.desc())
-        .all())
-    return book_instances
-
-
-def deactivate_any_bi_if_expired(expiration_period_days=30) -> None:
-    """ Update all b_instances status active -> inactive in DB if expired """
-    # month_ago = now - 30 days
-    expiration_time = datetime.today() - timedelta(days=expiration_period_days)
-    expiration_time_timestamp = datetime.timestamp(expiration_time)
-    (db.session.query(BookInstance)
-     .filter(BookInstance.is_active is True)
-     .filter(BookInstance.timestamp <= expiration_time_timestamp)
-     .update({
-         BookInstance.is_active: False,
-     }, synchronize_session=False))
+        .filter(BookInstance.is_active == true())
+        .filter(BookInstance.timestamp <= expiration_time))
+    if after is not None:
+        query = query.filter(
+            tuple_(BookInstance.owner_id, BookInstance.id) > tuple_(*after))
+    return (query
+            .order_by(BookInstance.owner_id, BookInstance.id)
+            .limit(limit)
+            .all())
+
+
+def deactivate_book_instances(book_instance_ids: List[int]) -> int:
+    """ Deactivate the book instances in one transaction,
+    returns number of deactivated ones.
+    """
+    deactivated = (db.session.query(BookInstance)
+                   .filter(BookInstance.id.in_(book_instance_ids))
+                   .filter(BookInstance.is_active == true())
+                   .update({BookInstance.is_active: False},
+                           synchronize_session=False))
+    _sync_fresh_listings(BookInstance.id.in_(book_instance_ids))
     db.session.commit()
+    for book_instance_id in book_instance_ids:
+        entity_cache.invalidate('book_instance', book_instance_id)
+        cluster_index.remove(book_instance_id)
+    return deactivated
 
 
 def activate_book_instance(book_instance_id) -> None:
@@ -467,30 +854,22 @@ def activate_book_instance(book_instance_id) -> None:
          BookInstance.is_active: True,
          BookInstance.timestamp: datetime.utcnow()
      }, synchronize_session=False))
+    _sync_fresh_listings(BookInstance.id == book_instance_id)
     db.session.commit()
+    entity_cache.invalidate('book_instance', int(book_instance_id))
+    _sync_clusters(BookInstance.id == book_instance_id)
 
 
 def deactivate_book_instance(book_instance_id) -> None:
     (db.session.query(BookInstance)
      .filter(BookInstance.id == book_instance_id)
      .update({BookInstance.is_active: False}, synchronize_session=False))
+    _sync_fresh_listings(BookInstance.id == book_instance_id)
     db.session.commit()
+    entity_cache.invalidate('book_instance', int(book_instance_id))
+    cluster_index.remove(int(book_instance_id))
 
 
-def get_active_bi_count(days: int = 0) -> int:
-    ''' Returns quantity of active BookInstance objects created during last X days.
-    if days == 0 --> count all active BookInstances.
-    '''
-    if days:
-        time_from = (datetime.today() - timedelta(days))
-        return (BookInstance.query
-                .filter(BookInstance.timestamp > time_from)
-                .filter(BookInstance.is_active == True)
-                .count())
-    return (BookInstance.query
-            .filter(BookInstance.is_active == True)
-            .count())
-
 #  ------------ USER ------------------
 
 
@@ -498,6 +877,7 @@ def get_user_by_username(username: str) -> User:
     return User.query.filter_by(username=username).first_or_404()
 
 
+@cached('user')
 def get_user_by_id(id: int) -> User:
     return User.query.filter_by(id=id).first_or_404()
 
@@ -516,11 +896,16 @@ def update_user_profile(
                 User.about_me: about_me,
                 User.latitude: latitude,
                 User.longitude: longitude,
+                User.geo_cell: cell_id(latitude, longitude),
             },
             synchronize_session=False,
             )
             )
+    _sync_fresh_listings(User.username == username)
     db.session.commit()
+    entity_cache.invalidate('user', db.session.query(User.id)
+                            .filter(User.username == username).scalar())
+    _sync_clusters(User.username == username)
     return user
 
 
@@ -534,6 +919,7 @@ def create_user(username: str, email: str, avatar: str, latitude=50.4547,
         avatar=avatar,
         latitude=latitude,
         longitude=longitude,
+        geo_cell=cell_id(latitude, longitude),
         about_me='you can contact me at @Telegram_my_acc',
         is_active=True
     )
@@ -543,23 +929,15 @@ def create_user(username: str, email: str, avatar: str, latitude=50.4547,
 
 
 def delete_user(user_id) -> None:
+    (FreshListing.query
+     .filter(FreshListing.owner_id == user_id)
+     .delete(synchronize_session=False))
     User.query.filter_by(id=user_id).delete()
     # TODO cascade delete all users book_instances???
     # Check if it generate any errors related to messages
     # (no recepient for exmpl)
     db.session.commit()
-
-
-def get_count_active_users(days: int = 0) -> int:
-    ''' Returns quantity of active Users during last X days.
-    if days == 0 --> count all active Users.
-    '''
-    if days:
-        time_from = (datetime.today() - timedelta(days))
-        return (User.query
-                .filter(User.last_seen > time_from)
-                .count())
-    return User.query.count()
+    entity_cache.invalidate('user', int(user_id))
 
 
 #  ------------ MESSAGE ------------------
@@ -570,15 +948,90 @@ def get_message(message_id) -> Message:
     return message
 
 
-def get_messages_by_user(user_id) -> List[Message]:
-    """ Returns non-deleted users Messages (both sent and received) """
-    messages = (
-        Message.query
-        .filter(
-            or_(
-                and_(Message.sender_id == user_id,
-                     Message.exists_for_sender == 1),
-                and_(Message.recipient_id == user_id,
-                     Message.exists_for_recipient == 1)))
-        .order_by(Message.timestamp.desc()))
-    return messages
+def create_message(
+        sender_id: int,
+        recipient_id: int,
+        body: str,
+        book_id: int,
+        book_instance_id: int) -> Message:
+    """ Add the message and bump recipient's unread_messages counter
+    in one transaction
+    """
+    message = Message(
+        book_id=book_id,
+        book_instance_id=book_instance_id,
+        sender_id=sender_id,
+        recipient_id=recipient_id,
+        body=body,
+        timestamp=datetime.utcnow(),
+    )
+    db.session.add(message)
+    (User.query
+     .filter(User.id == recipient_id)
+     .update({User.unread_messages: User.unread_messages + 1},
+             synchronize_session=False))
+    db.session.commit()
+    entity_cache.invalidate('user', int(recipient_id))
+    return message
+
+
+def _messages_page(
+        user_id: int,
+        is_sender: bool,
+        before: Union[Tuple[datetime, int], None],
+        limit: int) -> list:
+    """ Returns (Message, sender_username, recipient_username) rows
+    sent (or received) by the user, newest first.
+    """
+    sender, recipient = aliased(User), aliased(User)
+    if is_sender:
+        criterion = and_(Message.sender_id == user_id,
+                         Message.exists_for_sender == 1)
+    else:
+        criterion = and_(Message.recipient_id == user_id,
+                         Message.exists_for_recipient == 1)
+    query = (db.session.query(Message, sender.username, recipient.username)
+             .join(sender, Message.sender_id == sender.id)
+             .join(recipient, Message.recipient_id == recipient.id)
+             .filter(criterion))
+    if before is not None:
+        timestamp, message_id = before
+        query = query.filter(or_(
+            Message.timestamp < timestamp,
+            and_(Message.timestamp == timestamp, Message.id < message_id)))
+    return (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit)
+            .all())
+
+
+def get_messages_by_user(
+        user_id: int,
+        before: Union[Tuple[datetime, int], None] = None,
+        limit: int = 50) -> Tuple[list, Union[Tuple[datetime, int], None]]:
+    """ Returns page of non-deleted users Messages (both sent and received)
+    and cursor of the next (older) page or None if it's the last one.
+    Args:
+     - before: cursor (timestamp, id), only older messages are returned
+     - limit: page size
+
+    Messages are (Message, sender_username, recipient_username) rows ordered
+    by (timestamp, id) desc. Sent and received messages are read by two
+    queries, each uses its own (user_id, timestamp) index and stops after
+    limit + 1 rows, so the cost doesn't depend on the inbox size.
+    """
+    rows = heapq.merge(
+        _messages_page(user_id, True, before, limit + 1),
+        _messages_page(user_id, False, before, limit + 1),
+        key=lambda row: (row[0].timestamp, row[0].id),
+        reverse=True)
+    messages, seen = [], set()
+    for row in rows:
+        if row[0].id not in seen:  # a message to yourself is in both
+            seen.add(row[0].id)
+            messages.append(row)
+    if len(messages) <= limit:
+        return messages, None
+    messages = messages[:limit]
+    last = messages[-1][0]
+    return messages, (last.timestamp, last.id)
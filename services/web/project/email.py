@@ -11,18 +11,26 @@ def send_async_email(app, msg):
         mail.send(msg)
 
 
-def send_email(subject, sender, recipients, text_body, html_body):
+def send_email(subject, sender, recipients, text_body, html_body,
+               asynchronous=True):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
+    if not asynchronous:  # e.g. from a background job, no thread per email
+        mail.send(msg)
+        return
     Thread(target=send_async_email, args=(app, msg)).start()
 
 
-def send_email_bi_is_expired(recipients: str, expired_bis: list):
+def send_email_bi_is_expired(
+        recipients: str,
+        expired_bis: list,
+        asynchronous: bool = True):
     """
     Args:
      - recipients(str) - user's email
      - list of the user expired book_instances
+     - asynchronous - send it in a separate thread
     """
     subject = 'Some your books needs to be updated'
     sender = os.environ.get('MAIL_USERNAME')
@@ -38,7 +46,8 @@ def send_email_bi_is_expired(recipients: str, expired_bis: list):
     html_body += f'''</br>To update your books status
     <a href="{current_app.config['BASEDIR']}">Login</a>
     and visit your profile page</br> BR, Booklib team.'''
-    send_email(subject, sender, recipients, text_body, html_body)
+    send_email(subject, sender, recipients, text_body, html_body,
+               asynchronous=asynchronous)
 
 
 def send_email_got_new_message(
@@ -0,0 +1,111 @@
+import math
+from typing import List, Tuple, Union
+
+import numpy as np
+
+'''
+Geo helpers: distances and grid cells used as a spatial index.
+
+The Earth is split into CELL_SIZE x CELL_SIZE degrees cells. Every User
+stores id of the cell of his location (User.geo_cell, B-tree indexed), so
+"what is near" is an indexed lookup by the few cells covering the area,
+then exact distances are calculated for the found rows only.
+Works the same on SQLite and PostgreSQL, no PostGIS needed.
+'''
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.2  # along a meridian
+CELL_SIZE = 0.05  # degrees, ~5.5 km along a meridian
+CELL_COLUMNS = 10000  # > 360 / CELL_SIZE, cell_id = row * CELL_COLUMNS + col
+MAX_CELLS = 400  # bigger areas aren't looked up by cells, see cells_in_bbox
+
+
+def haversine(lat_1: float, lon_1: float, lat_2: float, lon_2: float) -> float:
+    """ Returns distance between two points in km """
+    lat_1, lon_1, lat_2, lon_2 = map(math.radians, (lat_1, lon_1, lat_2, lon_2))
+    a = (math.sin((lat_2 - lat_1) / 2) ** 2
+         + math.cos(lat_1) * math.cos(lat_2)
+         * math.sin((lon_2 - lon_1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def haversine_np(
+        latitude: float,
+        longitude: float,
+        latitudes: np.ndarray,
+        longitudes: np.ndarray) -> np.ndarray:
+    """ Returns distances (km) from the point to all the points at once """
+    lat_1, lon_1 = np.radians(latitude), np.radians(longitude)
+    lat_2, lon_2 = np.radians(latitudes), np.radians(longitudes)
+    a = (np.sin((lat_2 - lat_1) / 2) ** 2
+         + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _row(latitude: float) -> int:
+    return int(math.floor((latitude + 90) / CELL_SIZE))
+
+
+def _col(longitude: float) -> int:
+    return int(math.floor((longitude + 180) / CELL_SIZE))
+
+
+def cell_id(latitude, longitude) -> Union[int, None]:
+    """ Returns id of the grid cell the point belongs to """
+    if latitude is None or longitude is None:
+        return None
+    return _row(float(latitude)) * CELL_COLUMNS + _col(float(longitude))
+
+
+def bbox_around(
+        latitude: float,
+        longitude: float,
+        radius_km: float) -> Tuple[float, float, float, float]:
+    """ Returns (min_lon, min_lat, max_lon, max_lat) of the square around
+    the point, which contains the circle of radius_km.
+    """
+    lat_delta = radius_km / KM_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(latitude)), 0.01)
+    lon_delta = min(radius_km / (KM_PER_DEGREE * cos_lat), 180)
+    return (longitude - lon_delta, max(latitude - lat_delta, -90),
+            longitude + lon_delta, min(latitude + lat_delta, 90))
+
+
+def cells_in_bbox(
+        bbox: Tuple[float, float, float, float],
+        max_cells: int = MAX_CELLS) -> Union[List[int], None]:
+    """ Returns ids of the cells covering the bbox
+    (min_lon, min_lat, max_lon, max_lat) or None if there are more than
+    max_cells of them (i.e. the area is too big to use cells index).
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if not -180 <= min_lon <= max_lon < 180:
+        return None  # crosses the antimeridian (or is inverted)
+    rows = range(_row(min_lat), _row(max_lat) + 1)
+    cols = range(_col(min_lon), _col(max_lon) + 1)
+    if len(rows) * len(cols) > max_cells:
+        return None
+    return [row * CELL_COLUMNS + col for row in rows for col in cols]
+
+
+def max_radius_km(
+        latitude: float,
+        longitude: float,
+        radius_km: float,
+        max_cells: int = MAX_CELLS) -> float:
+    """ Returns radius_km or the biggest smaller radius (0.1 km precision)
+    which bbox around the point is covered by max_cells cells at most, i.e.
+    the area is looked up by the cells index.
+    """
+    if cells_in_bbox(bbox_around(latitude, longitude, radius_km),
+                     max_cells) is not None:
+        return radius_km
+    low, high = 0.0, radius_km
+    while high - low > 0.1:
+        middle = (low + high) / 2
+        if cells_in_bbox(bbox_around(latitude, longitude, middle),
+                         max_cells) is None:
+            high = middle
+        else:
+            low = middle
+    return low
@@ -1,7 +1,7 @@
 from .models import Book, BookInstance, User
 from flask_admin import BaseView, expose
-from .db_handlers import (
-    obj_counter, get_active_bi_count, get_count_active_users)
+from .cache import entity_cache
+from .utils import get_cached_analytics
 from flask_admin.contrib.sqla import ModelView
 from flask_admin.contrib.fileadmin import FileAdmin
 import os.path as op
@@ -19,26 +19,9 @@ class AnalyticsView(BaseView):
     def index(self):
         return self.render(
             'analytics_index.html',
-            total_active_users=get_count_active_users(),  # all
-            total_users=obj_counter(User),
-            total_books=obj_counter(Book),
-            total_bis=obj_counter(BookInstance),
-            total_active_bis=get_active_bi_count(),
-            month_active_users=get_count_active_users(30),  # month
-            month_users=obj_counter(User, 30),
-            month_books=obj_counter(Book, 30),
-            month_bis=obj_counter(BookInstance, 30),
-            month_active_bis=get_active_bi_count(30),
-            week_active_users=get_count_active_users(7),  # week
-            week_users=obj_counter(User, 7),
-            week_books=obj_counter(Book, 7),
-            week_bis=obj_counter(BookInstance, 7),
-            week_active_bis=get_active_bi_count(7),
-            day_active_users=get_count_active_users(1),  # day
-            day_users=obj_counter(User, 1),
-            day_books=obj_counter(Book, 1),
-            day_bis=obj_counter(BookInstance, 1),
-            day_active_bis=get_active_bi_count(1),
+            stats=get_cached_analytics(),
+            rows=(('Total', 0), ('Month', 30), ('Week', 7), ('Day', 1)),
+            cache_stats=entity_cache.stats(),
         )
 
 
@@ -0,0 +1,55 @@
+import re
+from typing import Union
+
+'''
+ISBN canonicalization: every book ISBN (10 or 13 digits) is stored as ISBN-13
+in Book.isbn (unique index), so "does the book exist" is one indexed lookup
+whatever ISBN a user has entered.
+'''
+
+NOT_ISBN_RE = re.compile(r'[^0-9X]')
+
+
+def is_valid_isbn_10(isbn_10: str) -> bool:
+    """ Checks ISBN-10 (10 chars, the last one may be 'X') checksum """
+    if len(isbn_10) != 10 or not isbn_10[:9].isdigit():
+        return False
+    if not (isbn_10[9].isdigit() or isbn_10[9] == 'X'):
+        return False
+    digits = [int(d) for d in isbn_10[:9]] + [
+        10 if isbn_10[9] == 'X' else int(isbn_10[9])]
+    return sum((i + 1) * d for i, d in enumerate(digits)) % 11 == 0
+
+
+def is_valid_isbn_13(isbn_13: str) -> bool:
+    """ Checks ISBN-13 (13 digits) checksum """
+    if len(isbn_13) != 13 or not isbn_13.isdigit():
+        return False
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(isbn_13))
+    return total % 10 == 0
+
+
+def isbn_10_to_13(isbn_10: str) -> int:
+    """ Returns ISBN-13 of ISBN-10: 978 prefix, new check digit """
+    digits = '978' + isbn_10[:9]
+    total = sum(int(d) * (3 if i % 2 else 1) for i, d in enumerate(digits))
+    return int(digits + str((10 - total % 10) % 10))
+
+
+def canonical_isbn(isbn) -> Union[int, None]:
+    """ Returns ISBN-13 (int) of ISBN-10 or ISBN-13 given as str
+    (dashes / spaces are ignored) or int, None if it's not a valid ISBN.
+
+    9 digits are ISBN-10 stored as int, i.e. without the leading '0' or
+    the check digit 'X'.
+    """
+    if isbn is None:
+        return None
+    isbn = NOT_ISBN_RE.sub('', str(isbn).upper())
+    if len(isbn) == 9:
+        isbn = '0' + isbn if is_valid_isbn_10('0' + isbn) else isbn + 'X'
+    if is_valid_isbn_13(isbn):
+        return int(isbn)
+    if is_valid_isbn_10(isbn):
+        return isbn_10_to_13(isbn)
+    return None
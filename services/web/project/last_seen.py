@@ -0,0 +1,79 @@
+import atexit
+import time
+from datetime import datetime
+from threading import Lock
+from typing import Dict
+
+from sqlalchemy import bindparam
+
+from . import app, db
+from .models import User
+
+'''
+Write-behind buffer for User.last_seen.
+
+before_request used to set last_seen and commit on every authenticated
+request: a write transaction per page view. Now the time is put into the
+buffer (one entry per user, the latest time wins) and all the buffered users
+are written by one bulk UPDATE when the buffer gets max_users entries or
+flush_seconds passed since the last flush. A background job flushes it
+periodically (see routes.py) and it's flushed on the process exit as well, so
+last_seen in DB lags behind by flush_seconds at most.
+'''
+
+
+class LastSeenBuffer:
+
+    def __init__(self, flush_seconds: float = 60, max_users: int = 1000):
+        self.flush_seconds = flush_seconds
+        self.max_users = max_users
+        self._last_seen: Dict[int, datetime] = dict()
+        self._flushed_at = time.monotonic()
+        self._lock = Lock()
+
+    def touch(self, user_id: int, when: datetime = None) -> None:
+        """ Remember the user was seen now (or at `when`) """
+        with self._lock:
+            self._last_seen[user_id] = when or datetime.utcnow()
+            is_due = (len(self._last_seen) >= self.max_users
+                      or time.monotonic() - self._flushed_at
+                      >= self.flush_seconds)
+        if is_due:
+            try:
+                self.flush()
+            except Exception:  # the times are kept for the next flush
+                app.logger.exception('last_seen flush failed')
+
+    def flush(self) -> int:
+        """ Write the buffered times by one bulk UPDATE,
+        returns number of updated users.
+        If the UPDATE fails the times are put back into the buffer (unless
+        the users were seen later meanwhile) and the error is raised.
+        """
+        with self._lock:
+            last_seen, self._last_seen = self._last_seen, dict()
+            self._flushed_at = time.monotonic()
+        if not last_seen:
+            return 0
+        statement = (User.__table__.update()
+                     .where(User.id == bindparam('user_id'))
+                     .values(last_seen=bindparam('seen_at')))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(statement, [
+                    {'user_id': user_id, 'seen_at': seen_at}
+                    for user_id, seen_at in last_seen.items()])
+        except Exception:
+            with self._lock:
+                for user_id, seen_at in last_seen.items():
+                    if self._last_seen.get(user_id, seen_at) <= seen_at:
+                        self._last_seen[user_id] = seen_at
+            raise
+        return len(last_seen)
+
+
+last_seen_buffer = LastSeenBuffer(
+    flush_seconds=app.config['LAST_SEEN_FLUSH_SECONDS'],
+    max_users=app.config['LAST_SEEN_FLUSH_USERS'],
+)
+atexit.register(last_seen_buffer.flush)
@@ -1,6 +1,8 @@
 from datetime import datetime
 from flask_login import UserMixin
+from sqlalchemy import event
 from . import db, login
+from .cache import invalidate_on_flush
 # from sqlalchemy import BigInteger
 
 
@@ -12,11 +14,12 @@ class User(UserMixin, db.Model):
     is_active = db.Column(db.Boolean, default=True)
     tokens = db.Column(db.Text)
     is_admin = db.Column(db.Boolean, default=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow())
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow())
     latitude = db.Column(db.Float)
     longitude = db.Column(db.Float)
+    geo_cell = db.Column(db.Integer, index=True)  # see geo.cell_id()
     about_me = db.Column(db.String(140))
-    last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     BookInstance = db.relationship('BookInstance', backref='owner',
                                    lazy='dynamic'
                                    )
@@ -28,6 +31,9 @@ class User(UserMixin, db.Model):
                                         backref='recipient', lazy='dynamic')
     last_message_read_time = db.Column(
         db.DateTime, default=datetime(1900, 1, 1))
+    # denormalized new_messages(), see db_handlers.create_message
+    unread_messages = db.Column(db.Integer, default=0, server_default='0',
+                                nullable=False)
 
     def new_messages(self):
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
@@ -43,10 +49,20 @@ class BookInstance(db.Model):
     price = db.Column(db.Integer)
     condition = db.Column(db.Integer)
     description = db.Column(db.String(2000))
-    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id'))
     is_active = db.Column(db.Boolean(), default=True)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # Partial indexes (active instances only) on PostgreSQL,
+    # plain composite indexes on other DBs. (book_id, is_active) isn't
+    # partial, it serves all book_id lookups too.
+    __table_args__ = (
+        db.Index('ix_book_instance_active_book_id', 'book_id', 'is_active'),
+        db.Index('ix_book_instance_active_timestamp', 'is_active', 'timestamp',
+                 postgresql_where=db.text('is_active')),
+        db.Index('ix_book_instance_active_owner_id', 'is_active', 'owner_id',
+                 'id', postgresql_where=db.text('is_active')),
+    )
 
     def __repr__(self):
         return f'BookInstance: {self.Book.title} {self.price}'
@@ -54,15 +70,25 @@ class BookInstance(db.Model):
 
 class Book(db.Model):
     id = db.Column(db.Integer, autoincrement=True, primary_key=True)
-    isbn_10 = db.Column(db.BigInteger())
-    isbn_13 = db.Column(db.BigInteger())
+    isbn_10 = db.Column(db.BigInteger(), index=True)
+    isbn_13 = db.Column(db.BigInteger(), index=True)
+    # canonical ISBN-13 of isbn_13 or isbn_10, see isbn.canonical_isbn()
+    isbn = db.Column(db.BigInteger(), index=True, unique=True)
     title = db.Column(db.String(140))
     author = db.Column(db.String(140))
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     instance_counter = db.Column(db.Integer, default=0)
+    # any change of the row, incl. bulk UPDATEs (see search.SearchIndex.sync)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow,
+                           onupdate=datetime.utcnow)
     BookInstance = db.relationship(
         'BookInstance', backref='Book', lazy='dynamic')
+    __table_args__ = (
+        db.Index('ix_book_title_author', 'title', 'author'),
+        db.Index('ix_book_updated_at', 'updated_at'),
+        db.Index('ix_book_created_by_timestamp', 'created_by', 'timestamp'),
+    )
 
     def __repr__(self):
         return f'Book: {self.title}'
@@ -78,11 +104,136 @@ class Message(db.Model):
     exists_for_recipient = db.Column(db.Integer, default=1)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_message_sender_id_timestamp', 'sender_id', 'timestamp'),
+        db.Index('ix_message_recipient_id_timestamp',
+                 'recipient_id', 'timestamp'),
+    )
 
     def __repr__(self):
         return '<Message {}>'.format(self.body)
 
 
+class FreshListing(db.Model):
+    """ Denormalized feed of active book instances for the home page
+    (see db_handlers.get_freshest_book_instances): the owner & book columns
+    the tile needs, no joins. Kept in sync in the same transaction as the
+    book instance: ORM flushes of BookInstance, User, Book (e.g. admin panel)
+    by the mapper events below, bulk UPDATEs of db_handlers by calling
+    sync_fresh_listings. Only FRESH_LISTINGS_LIMIT newest listings are kept
+    (see db_handlers.trim_fresh_listings).
+    """
+    id = db.Column(db.Integer,
+                   db.ForeignKey('book_instance.id', ondelete='CASCADE'),
+                   primary_key=True)  # BookInstance.id
+    book_id = db.Column(db.Integer)
+    owner_id = db.Column(db.Integer, index=True)
+    username = db.Column(db.String(64))
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    title = db.Column(db.String(140))
+    author = db.Column(db.String(140))
+    price = db.Column(db.Integer)
+    condition = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_fresh_listing_timestamp_id', 'timestamp', 'id'),
+    )
+
+    def __repr__(self):
+        return f'FreshListing: {self.id}'
+
+
+class DailyStats(db.Model):
+    """ Daily rollup for the admin analytics: rows created during the day
+    (see db_handlers.rollup_daily_stats)
+    """
+    day = db.Column(db.Date, primary_key=True)
+    users = db.Column(db.Integer, default=0)
+    books = db.Column(db.Integer, default=0)
+    book_instances = db.Column(db.Integer, default=0)
+
+    def __repr__(self):
+        return f'DailyStats: {self.day}'
+
+
 @login.user_loader
 def load_user(id):
+    """ Read per request, not through entity_cache: current_user is
+    written to (e.g. unread_messages reset) and must match the DB row
+    """
     return User.query.get(int(id))
+
+
+invalidate_on_flush(User, 'user')
+invalidate_on_flush(Book, 'book')
+invalidate_on_flush(BookInstance, 'book_instance')
+
+
+FRESH_LISTING_COLUMNS = ('id', 'book_id', 'owner_id', 'username', 'latitude',
+                         'longitude', 'title', 'author', 'price', 'condition',
+                         'timestamp')
+
+
+def fresh_listings_select(criterion):
+    """ Active book instances matched criterion as FreshListing columns """
+    return (db.select([
+        BookInstance.id,
+        BookInstance.book_id,
+        BookInstance.owner_id,
+        User.username,
+        User.latitude,
+        User.longitude,
+        Book.title,
+        Book.author,
+        BookInstance.price,
+        BookInstance.condition,
+        BookInstance.timestamp])
+        .where(BookInstance.owner_id == User.id)
+        .where(BookInstance.book_id == Book.id)
+        .where(BookInstance.is_active == db.true())
+        .where(criterion))
+
+
+def sync_fresh_listings(connection, criterion) -> None:
+    """ Rewrite the home page feed rows of the book instances matched
+    criterion (inactive ones are removed) on the connection, i.e. in its
+    transaction
+    """
+    book_instance_ids = (db.select([BookInstance.id])
+                         .where(BookInstance.owner_id == User.id)
+                         .where(BookInstance.book_id == Book.id)
+                         .where(criterion))
+    connection.execute(FreshListing.__table__.delete()
+                       .where(FreshListing.id.in_(book_instance_ids)))
+    connection.execute(FreshListing.__table__.insert().from_select(
+        FRESH_LISTING_COLUMNS, fresh_listings_select(criterion)))
+
+
+@event.listens_for(BookInstance, 'after_insert')
+@event.listens_for(BookInstance, 'after_update')
+def _sync_book_instance_listing(mapper, connection, target):
+    """ Book instances added / edited by ORM (e.g. admin panel) """
+    sync_fresh_listings(connection, BookInstance.id == target.id)
+
+
+@event.listens_for(User, 'after_update')
+def _sync_user_listings(mapper, connection, target):
+    """ Owner username / location edits by ORM (e.g. admin panel) """
+    state = db.inspect(target)
+    if any(state.attrs[key].history.has_changes()
+           for key in ('username', 'latitude', 'longitude')):
+        sync_fresh_listings(connection, BookInstance.owner_id == target.id)
+
+
+@event.listens_for(Book, 'after_update')
+def _update_fresh_listings(mapper, connection, target):
+    """ Book title / author edits (e.g. admin panel) go to its FreshListing
+    rows in the same transaction
+    """
+    state = db.inspect(target)
+    if (state.attrs.title.history.has_changes()
+            or state.attrs.author.history.has_changes()):
+        connection.execute(FreshListing.__table__.update()
+                           .where(FreshListing.book_id == target.id)
+                           .values(title=target.title, author=target.author))
@@ -0,0 +1,153 @@
+from contextlib import contextmanager
+from functools import wraps
+
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, _EngineConnector
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import Delete, Insert, Update
+
+'''
+Read replica routing.
+
+If SQLALCHEMY_BINDS has 'replica' database (REPLICA_DATABASE_URL env), the
+queries made by the functions decorated with @read_only (and inside
+`with replica():`) go to the replica, everything else, including any write
+(flush, bulk update / delete), goes to the primary database.
+
+The replica may lag behind the primary, so only the handlers which can show
+slightly stale data (listings, search, analytics) are routed there.
+Without the replica configured the decorator does nothing.
+
+Inside replica() db.session is a separate session (db.replica_session), so
+the objects read from the replica never share the identity map with the
+ones read from the primary, e.g. a stale replica row can't be returned for
+the primary lookup of the same id. Don't change objects inside replica():
+its session isn't committed by the callers. The replica engine is configured
+by SQLALCHEMY_REPLICA_ENGINE_OPTIONS (pool sizes etc.), not by the primary's
+SQLALCHEMY_ENGINE_OPTIONS.
+
+To try it locally with SQLite: copy the DB file and set
+DATABASE_URL=sqlite:///primary.db REPLICA_DATABASE_URL=sqlite:///replica.db,
+then run 'manage.py check_replica_routing'.
+'''
+
+REPLICA_BIND = 'replica'
+
+
+class RoutingSession(SignallingSession):
+    """ Session which reads from the replica if use_replica is set """
+
+    use_replica = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if (self.use_replica
+                and not self._flushing
+                and not isinstance(clause, (Insert, Update, Delete))
+                and REPLICA_BIND in self.app.config['SQLALCHEMY_BINDS']):
+            return self.app.extensions['sqlalchemy'].db.get_engine(
+                self.app, bind=REPLICA_BIND)
+        return super().get_bind(mapper, clause)
+
+
+class ReplicaSession(RoutingSession):
+    """ db.session inside replica() context, reads from the replica """
+
+    use_replica = True
+    primary_session = None  # db.session outside the context
+
+
+class _RoutingEngineConnector(_EngineConnector):
+    """ Engine connector which configures the replica engine by
+    SQLALCHEMY_REPLICA_ENGINE_OPTIONS
+    """
+
+    def get_options(self, sa_url, echo):
+        if self._bind != REPLICA_BIND:
+            return super().get_options(sa_url, echo)
+        options = {}
+        self._sa.apply_pool_defaults(self._app, options)
+        self._sa.apply_driver_hacks(self._app, sa_url, options)
+        if echo:
+            options['echo'] = echo
+        options.update(self._app.config['SQLALCHEMY_REPLICA_ENGINE_OPTIONS'])
+        options.update(self._sa._engine_options)
+        return options
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy with RoutingSession as db.session and ReplicaSession as
+    db.replica_session (see replica())
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.replica_session = None
+        super().__init__(*args, **kwargs)
+        self.replica_session = self.create_scoped_session(
+            {'class_': ReplicaSession})
+
+    def init_app(self, app):
+        super().init_app(app)
+
+        @app.teardown_appcontext
+        def remove_replica_session(response_or_exc):
+            if self.replica_session is not None:
+                self.replica_session.remove()
+            return response_or_exc
+
+    def create_session(self, options):
+        options.setdefault('class_', RoutingSession)
+        return orm.sessionmaker(db=self, **options)
+
+    def make_connector(self, app=None, bind=None):
+        return _RoutingEngineConnector(self, self.get_app(app), bind)
+
+
+@contextmanager
+def replica():
+    """ Queries inside the context read from the replica,
+    by db.replica_session
+    """
+    from . import db
+
+    registry = db.session.registry
+    session = registry()
+    if (isinstance(session, ReplicaSession)
+            or REPLICA_BIND not in db.get_app().config['SQLALCHEMY_BINDS']):
+        yield
+        return
+    replica_session = db.replica_session()
+    replica_session.primary_session = session
+    registry.set(replica_session)
+    try:
+        yield
+    finally:
+        registry.set(session)
+
+
+@contextmanager
+def primary():
+    """ Queries inside the context read from the primary DB, even inside
+    replica() (e.g. to check the rows just written)
+    """
+    from . import db
+
+    registry = db.session.registry
+    session = registry()
+    if not isinstance(session, ReplicaSession):
+        yield
+        return
+    registry.set(session.primary_session)
+    try:
+        yield
+    finally:
+        registry.set(session)
+
+
+def read_only(func):
+    """ Decorator of read-only db_handlers: route their queries to the
+    replica
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with replica():
+            return func(*args, **kwargs)
+    return wrapper
@@ -1,3 +1,5 @@
+import json
+import math
 import os
 from datetime import datetime
 
@@ -5,18 +7,22 @@ import folium
 import folium.plugins
 from apscheduler.schedulers.background import BackgroundScheduler
 from authlib.integrations.flask_client import OAuth
-from flask import (current_app, flash, g, redirect, render_template, request,
-                   session, url_for)
+from flask import (abort, current_app, flash, g, jsonify, redirect,
+                   render_template, request, session, url_for)
 from flask_login import current_user, login_required, login_user, logout_user
 
 from . import app, db, db_handlers, utils
+from .clusters import cluster_index
+from .cover_worker import BUSY, DONE, FAILED, QUEUED, cover_worker
 from .email import send_email_got_new_message
 from .forms import (AddBookByIsbnForm, AddBookForm, AddIsbnForm, AddCoverForm,
                     EditBookInstanceForm, EditProfileForm, MessageForm,
                     SearchForm)
 from .gbooks import get_book_by_isbn
-from .models import Book, Message, User
-from .thumbs import thumbnail
+from .geo import max_radius_km
+from .isbn import canonical_isbn
+from .last_seen import last_seen_buffer
+from .models import Message, User
 
 # oauth configuration
 CONF_URL = 'https://accounts.google.com/.well-known/openid-configuration'
@@ -37,32 +43,77 @@ scheduler = BackgroundScheduler()
 # https://stackoverflow.com/questions/14874782/apscheduler-in-flask-executes-twice
 scheduler.start()
 scheduler.add_job(
-    func=utils.expired_bi_handler,
+    func=utils.expired_bi_job,
     trigger="interval",
     days=1,
 )
+scheduler.add_job(
+    func=utils.rebuild_clusters_job,
+    trigger="interval",
+    minutes=app.config['CLUSTERS_REBUILD_MINUTES'],
+)  # the first build: on the first tile request, see cluster_tile
+scheduler.add_job(
+    func=utils.trim_fresh_listings_job,
+    trigger="interval",
+    minutes=app.config['FRESH_LISTINGS_TRIM_MINUTES'],
+)
+scheduler.add_job(
+    func=last_seen_buffer.flush,
+    trigger="interval",
+    seconds=app.config['LAST_SEEN_FLUSH_SECONDS'],
+)
+if app.config['ANALYTICS_USE_ROLLUP']:
+    scheduler.add_job(
+        func=utils.rollup_daily_stats_job,
+        trigger="interval",
+        hours=1,  # only finished days are rolled up, once
+        next_run_time=datetime.now(),
+    )
 
 
 @app.route('/', methods=['GET', 'POST'])
 @app.route('/index', methods=['GET', 'POST'])
 def index():
-    books = Book.query.all()
+    books, next_url = _library_page()
     book_instances = db_handlers.get_freshest_book_instances(30)
-    books_ids = [bi.book_id for bi in book_instances]
-    utils.generate_map_by_book_id(list(books_ids))
+    map_html = utils.generate_clusters_map()
     return render_template(
         'index.html',
         title='Home',
         books=books,
+        next_url=next_url,
         book_instances=book_instances,
+        map_html=map_html,
+    )
+
+
+@app.route('/library')
+def library():
+    """ Next page of the home page library, html fragment for infinite scroll
+    """
+    books, next_url = _library_page()
+    return render_template('_library_page.html', books=books,
+                           next_url=next_url)
+
+
+def _library_page() -> tuple:
+    """ Returns books of the library page requested by after_id arg and url
+    of the next page (or None).
+    """
+    books, next_cursor = db_handlers.get_library_page(
+        after=request.args.get('after_id', type=int),
+        limit=current_app.config['LIBRARY_PER_PAGE'],
     )
+    next_url = None
+    if next_cursor is not None:
+        next_url = url_for('library', after_id=next_cursor)
+    return books, next_url
 
 
 @app.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen_buffer.touch(current_user.id)
         g.search_form = SearchForm()
         if request.path.startswith('/admin'):
             if not (current_user.id == 1 or current_user.is_admin):
@@ -75,21 +126,150 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('explore'))
     key_word = g.search_form.q.data
-    books = db_handlers.get_books_by_kw(key_word)
+    books = db_handlers.get_books_by_kw(
+        key_word,
+        limit=current_app.config['SEARCH_RESULTS_LIMIT'],
+        threshold=current_app.config['SEARCH_SIMILARITY_THRESHOLD'],
+    )
     books_ids = [b.id for b in books]
-    utils.generate_map_by_book_id(list(books_ids))
     if len(books) == 1:
         return redirect(url_for('book', book_id=books_ids[0]))
+    map_html = utils.generate_map_by_book_id(list(books_ids))
     if len(books) == 0:
         # return redirect(url_for('search_not_found'))
         return render_template(
-            'search_not_found.html', key_word=key_word)
+            'search_not_found.html', key_word=key_word, map_html=map_html)
     return render_template(
         'search.html',
         title='Search',
         books=books,
         key_word=key_word,
+        map_html=map_html,
+    )
+
+
+@app.route('/autocomplete')
+@login_required
+def autocomplete():
+    """ Search-as-you-type suggestions (JSON) """
+    key_word = request.args.get('q', '')
+    books = db_handlers.get_books_suggestions(
+        key_word,
+        limit=current_app.config['AUTOCOMPLETE_RESULTS_LIMIT'],
+    )
+    return jsonify(books=[{
+        'id': book.id,
+        'title': book.title,
+        'author': book.author,
+        'instance_counter': book.instance_counter,
+        'url': url_for('book', book_id=book.id),
+    } for book in books])
+
+
+@app.route('/api/map_data')
+def map_data():
+    """ GeoJSON of active book instances locations.
+    Args (query string):
+     - book_ids: comma separated Book ids, e.g. '1,2,3'
+     - bbox: min_lon,min_lat,max_lon,max_lat (longitudes of the wrapped
+       map may be out of -180..180)
+    """
+    try:
+        book_ids = request.args.get('book_ids')
+        if book_ids is not None:
+            book_ids = [int(i) for i in book_ids.split(',') if i]
+        bbox = request.args.get('bbox')
+        if bbox is not None:
+            bbox = tuple(float(i) for i in bbox.split(','))
+            if (len(bbox) != 4
+                    or not all(math.isfinite(i) for i in bbox)
+                    or not all(-90 <= i <= 90 for i in bbox[1::2])):
+                raise ValueError
+    except ValueError:
+        return jsonify(error='Invalid book_ids or bbox'), 400
+
+    data = utils.get_map_data(book_ids=book_ids, bbox=bbox)
+    response = current_app.response_class(
+        json.dumps(data, separators=(',', ':')),
+        mimetype='application/geo+json',
+    )
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['MAP_DATA_MAX_AGE']
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@app.route('/api/clusters/<int:z>/<int:x>/<int:y>')
+def cluster_tile(z, x, y):
+    """ GeoJSON of precomputed active book instances clusters
+    of the map tile z/x/y. Cluster property 'n' is number of instances.
+    The clusters are built by the background job scheduled on the first
+    request, until then the tiles are empty and not cached.
+    """
+    if cluster_index.use():
+        scheduler.add_job(func=utils.rebuild_clusters_job)
+    response = current_app.response_class(
+        json.dumps(cluster_index.tile(z, x, y), separators=(',', ':')),
+        mimetype='application/geo+json',
+    )
+    if not cluster_index.is_built:
+        response.cache_control.no_store = True
+        return response
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['MAP_DATA_MAX_AGE']
+    return response
+
+
+@app.route('/api/covers/<int:book_id>')
+def cover_status(book_id):
+    """ Status of the book cover upload (see cover_worker.py):
+    queued, done, failed or none (no cover)
+    """
+    job = cover_worker.status(book_id)
+    if job is None:  # wasn't uploaded to this process
+        exists = utils.refresh_cover(book_id)
+        job = {'status': DONE if exists else 'none', 'attempts': 0}
+    return jsonify(
+        book_id=book_id,
+        status=job['status'],
+        attempts=job['attempts'],
+        url=(url_for('static', filename=f'covers/{book_id}_m.jpg')
+             if job['status'] == DONE else None),
+    )
+
+
+@app.route('/api/nearby')
+@login_required
+def nearby():
+    """ Active book instances near the current user, the nearest go first.
+    Args (query string):
+     - radius: km, NEARBY_DEFAULT_RADIUS_KM by default. It's limited by
+       NEARBY_MAX_RADIUS_KM and the area the cells index covers (see
+       geo.max_radius_km), the radius used is returned.
+    """
+    try:
+        radius = float(request.args.get(
+            'radius', current_app.config['NEARBY_DEFAULT_RADIUS_KM']))
+    except ValueError:
+        return jsonify(error='Invalid radius'), 400
+    if not math.isfinite(radius):
+        return jsonify(error='Invalid radius'), 400
+    radius = min(max(radius, 0), current_app.config['NEARBY_MAX_RADIUS_KM'])
+    if current_user.latitude is None or current_user.longitude is None:
+        return jsonify(book_instances=[], radius=radius)
+    radius = max_radius_km(current_user.latitude, current_user.longitude,
+                           radius)
+
+    book_instances = db_handlers.get_active_bi_nearby(
+        latitude=current_user.latitude,
+        longitude=current_user.longitude,
+        radius_km=radius,
+        limit=current_app.config['NEARBY_RESULTS_LIMIT'],
     )
+    for bi in book_instances:
+        bi['distance'] = round(bi['distance'], 2)
+        bi['url'] = url_for('book_instance', book_instance_id=bi['id'])
+    return jsonify(book_instances=book_instances, radius=radius)
 
 
 @app.route('/users_location')
@@ -105,14 +285,13 @@ def users_location():
             popup=_user.username,
             icon=folium.Icon(color='green')
         ).add_to(m)
-    m.save('templates/_map.html')
-    return render_template('map.html')
+    return render_template('map.html', map_html=m.get_root().render())
 
 
 @app.route('/location/<book_id>')
 def book_location(book_id):
-    utils.generate_map_by_book_id([book_id])
-    return render_template('map.html')
+    map_html = utils.generate_map_by_book_id([book_id])
+    return render_template('map.html', map_html=map_html)
 
 
 @app.route('/user/<username>', methods=['GET', 'POST'])
@@ -132,23 +311,38 @@ def user(username):
 def book(book_id):
     """ Shows book detailed info """
 
-    _book = Book.query.filter_by(id=book_id).first_or_404()
-
-    book_instances = db_handlers.get_book_instances_by_book_id(book_id)
-    book_instances = sorted(book_instances, key=lambda x: x[4])
-    utils.generate_map_by_book_id([book_id])
-    cover_id = 0
-    if os.path.exists(os.path.join(
-            current_app.config["IMAGE_UPLOADS"], str(_book.id) + '.jpg')):
-        cover_id = _book.id
-    filepath = "/static/covers/" + str(cover_id) + ".jpg"
+    _book = db_handlers.get_book(book_id)
+    if _book is None:
+        abort(404)
+
+    offers = db_handlers.get_book_instances_by_book_id(book_id)
+    per_page = current_app.config['OFFERS_PER_PAGE']
+    pages = -(-len(offers) // per_page)
+    page = min(max(request.args.get('page', 1, type=int), 1), max(pages, 1))
+    book_instances, pages = utils.rank_offers(
+        offers,
+        latitude=current_user.latitude,
+        longitude=current_user.longitude,
+        weights=current_app.config['OFFERS_RANK_WEIGHTS'],
+        page=page,
+        per_page=per_page,
+    )
+    map_html = utils.generate_map_by_book_id([book_id])
+    # reloaded when the cover is made, maybe by another worker
+    if request.args.get('cover') == DONE and not utils.has_cover(_book.id):
+        utils.refresh_cover(_book.id)
+    cover_id = utils.get_cover_id(_book.id)
+    cover_job = cover_worker.status(_book.id)
     return render_template(
         'book_page.html',
         book=_book,
-        filepath=filepath,
         cover_id=cover_id,
+        cover_queued=bool(cover_job and cover_job['status'] == QUEUED),
         book_instances=book_instances,
+        page=page,
+        pages=pages,
         basedir=current_app.config['BASEDIR'],
+        map_html=map_html,
     )
 
 
@@ -160,16 +354,13 @@ def book_instance(book_instance_id):
     bi_owner = db_handlers.get_user_by_id(_book_instance.owner_id)
     form = MessageForm()
     if form.validate_on_submit():
-        msg = Message(
-            book_id=_book_instance.book_id,
-            book_instance_id=book_instance_id,
+        db_handlers.create_message(
             sender_id=current_user.id,
             recipient_id=_book_instance.owner_id,
             body=form.message.data,
-            timestamp=datetime.utcnow(),
+            book_id=_book_instance.book_id,
+            book_instance_id=book_instance_id,
         )
-        db.session.add(msg)
-        db.session.commit()
 
         # send email nofication to msg recipient
         recipient_email = (bi_owner.email)
@@ -182,8 +373,7 @@ def book_instance(book_instance_id):
         flash('Your message have been sent.')
         return redirect(url_for('messages'))
     # get bi owners coordinates and them to generate_map_single_marker()
-    bi_owner = db_handlers.get_user_by_id(_book_instance.owner_id)
-    utils.generate_map_single_marker(
+    map_html = utils.generate_map_single_marker(
         location=(bi_owner.latitude, bi_owner.longitude)
     )
     return render_template(
@@ -191,6 +381,7 @@ def book_instance(book_instance_id):
         book_instance=_book_instance,
         editable=editable,
         form=form,
+        map_html=map_html,
     )
 
 
@@ -213,6 +404,7 @@ def edit_profile():
             longitude,
             username=current_user.username,
         )
+        utils.clear_map_cache()
 
         flash('Your changes have been saved.')
         return redirect(url_for('user', username=current_user.username))
@@ -244,12 +436,7 @@ def add_book():
         isbn = str(''.join(filter(str.isdigit, form_by_isbn.isbn.data)))
 
         # check if book with the ISBN exist local DB:
-        # TODO simplify next block to one function
-        book_by_isbn = (
-            db_handlers.get_book_by_isbn_10(isbn)
-            or db_handlers.get_book_by_isbn_13(isbn)
-            or None
-        )
+        book_by_isbn = db_handlers.get_book_by_isbn(form_by_isbn.isbn.data)
         if book_by_isbn:
             flash('The book with ISBN you entered alreaty exists in DB')
             return redirect(url_for(
@@ -296,7 +483,7 @@ def delete_tmp_cover(gbook_id):
 def add_book_by_data():
     """ Add new book to DB, load a cover
     Supposed that this func calls when the book info is  seceived from gbooks.
-    So we do not need to crop image, only replace it from /tmp to /covers
+    The cover is moved from /tmp to /covers with its size variants.
     """
     book = session.get('gbook', None)
 
@@ -311,9 +498,8 @@ def add_book_by_data():
     book_id = new_book.id
     filepath = "project/static/tmp/" + str(book['gbook_id']) + ".jpg"
     if os.path.exists(filepath):
-        filepath_destination = os.path.join(
-            current_app.config["IMAGE_UPLOADS"], str(book_id) + '.jpg')
-        os.replace(filepath, filepath_destination)
+        utils.cover_upload(filepath, book_id)  # with the size variants
+        os.remove(filepath)
 
     return redirect(url_for('add_book_instance', book_id=book_id))
 
@@ -327,14 +513,12 @@ def add_book_manual():
         author = form.author.data
         # digits only
         isbn_10 = str(''.join(filter(str.isdigit, form.isbn_10.data)))
-        isbn_13 = str(''.join(filter(str.isdigit, form.isbn_10.data)))
+        isbn_13 = str(''.join(filter(str.isdigit, form.isbn_13.data)))
         cover = form.cover.data
 
-        book_by_isbn = None
-        if isbn_10:
-            book_by_isbn = db_handlers.get_book_by_isbn_10(isbn_10)
-        if isbn_13:
-            book_by_isbn = db_handlers.get_book_by_isbn_13(isbn_13)
+        # the same way create_book does: ISBN-10 if ISBN-13 is missing / wrong
+        isbn = canonical_isbn(isbn_13) or canonical_isbn(isbn_10)
+        book_by_isbn = isbn and db_handlers.get_book_by_isbn(isbn)
         if book_by_isbn:
             # ? TODO add popup with a message why user is redirected
             flash('The book with ISBN you entered alreaty exists in DB')
@@ -352,17 +536,14 @@ def add_book_manual():
             current_user_id=current_user.id,
         )
 
-        # download original cover file then replace it with cropped one
+        # cropped cover is made in background, the original isn't kept
         if cover:
-            utils.cover_upload(cover, new_book.id)
-            filepath = os.path.join(
-                current_app.config["IMAGE_UPLOADS"],
-                str(new_book.id) + '.jpg')
-            cover = thumbnail(
-                filepath,
-                current_app.config["IMAGE_TARGET_SIZE"],
-            )
-            utils.cover_upload(cover, new_book.id)
+            status = cover_worker.upload(cover, new_book.id)
+            if status == FAILED:
+                flash("The cover can't be read, add another one later")
+            elif status == BUSY:
+                flash('Too many covers are being processed now, '
+                      'add the cover a bit later')
 
         return redirect(url_for('add_book_instance', book_id=new_book.id))
     limit = current_app.config["NEW_BOOKS_PER_DAY_LIMIT"]
@@ -392,6 +573,7 @@ def add_book_instance(book_id):
             owner_id=current_user.id,
             book_id=book_id,
         )
+        utils.clear_map_cache()
         return redirect(url_for(
             'book_instance',
             book_instance_id=_book_instance.id,
@@ -412,22 +594,23 @@ def add_book_instance(book_id):
 def add_cover_to_book(book_id):
     _book = db_handlers.get_book(book_id)
     filepath = os.path.join(
-            current_app.config["IMAGE_UPLOADS"],
-            str(_book.id) + '.jpg')
+        current_app.config["IMAGE_UPLOADS"],
+        str(_book.id) + '.jpg')
 
-    #  check if cover already exist, do not allow upload.
-    if os.path.exists(filepath):
+    #  check if cover already exist (or is in work), do not allow upload.
+    job = cover_worker.status(_book.id)
+    if os.path.exists(filepath) or (job and job['status'] == QUEUED):
         return redirect(url_for('book', book_id=_book.id))
 
     form = AddCoverForm()
     if form.validate_on_submit():
-        cover = form.cover.data
-        utils.cover_upload(cover, _book.id)
-        cover = thumbnail(
-            filepath,
-            current_app.config["IMAGE_TARGET_SIZE"],
-        )
-        utils.cover_upload(cover, _book.id)
+        status = cover_worker.upload(form.cover.data, _book.id)
+        if status == FAILED:
+            flash("The cover can't be read, try another image")
+            return redirect(url_for('add_cover_to_book', book_id=_book.id))
+        if status == BUSY:
+            flash('Too many covers are being processed now, try a bit later')
+            return redirect(url_for('add_cover_to_book', book_id=_book.id))
         return redirect(url_for('book', book_id=_book.id))
 
     return render_template(
@@ -447,8 +630,8 @@ def add_isbn_to_book(book_id):
         isbn_13 = form.isbn_13.data
         # handle isbn_10
 
-        isbn_10_exist = db_handlers.get_book_by_isbn_10(isbn_10)
-        isbn_13_exist = db_handlers.get_book_by_isbn_13(isbn_13)
+        isbn_10_exist = db_handlers.get_book_by_isbn(isbn_10)
+        isbn_13_exist = db_handlers.get_book_by_isbn(isbn_13)
 
         if not isbn_10_exist:
             db_handlers.update_book_isbn_10(book_id, isbn_10)
@@ -475,7 +658,8 @@ def edit_book_instance(book_instance_id):
 
     form = EditBookInstanceForm()
     _book_instance = db_handlers.get_book_instance_by_id(book_instance_id)
-    if _book_instance.owner_id != current_user.id:
+    owner_id = db_handlers.get_book_instance_owner_id(book_instance_id)
+    if owner_id != current_user.id:
         flash("User allowed to edit only their own book instances")
         return render_template(
             'book_instance_page.html',
@@ -499,6 +683,7 @@ def edit_book_instance(book_instance_id):
             condition=condition,
             description=description,
         )
+        utils.clear_map_cache()
         return redirect(url_for(
             'book_instance',
             book_instance_id=book_instance_id)
@@ -508,6 +693,7 @@ def edit_book_instance(book_instance_id):
         'edit_book_instance.html',
         form=form,
         book_instance=_book_instance,
+        map_html=utils.generate_map_single_marker(),
     )
 
 
@@ -518,10 +704,11 @@ def edit_book_instance(book_instance_id):
 @login_required
 def activate_book_instance(book_instance_id):
     # check the user is a bi owner
-    _book_instance = db_handlers.get_book_instance_by_id(book_instance_id)
-    if current_user.id != _book_instance.owner_id:
+    owner_id = db_handlers.get_book_instance_owner_id(book_instance_id)
+    if current_user.id != owner_id:
         return redirect(url_for('index'))
     db_handlers.activate_book_instance(book_instance_id)
+    utils.clear_map_cache()
     return redirect(request.referrer)
 
 
@@ -532,10 +719,11 @@ def activate_book_instance(book_instance_id):
 @login_required
 def deactivate_book_instance(book_instance_id):
     # check the user is a bi owner
-    _book_instance = db_handlers.get_book_instance_by_id(book_instance_id)
-    if current_user.id != _book_instance.owner_id:
+    owner_id = db_handlers.get_book_instance_owner_id(book_instance_id)
+    if current_user.id != owner_id:
         return redirect(url_for('index'))
     db_handlers.deactivate_book_instance(book_instance_id)
+    utils.clear_map_cache()
     return redirect(request.referrer)
 
 
@@ -545,10 +733,11 @@ def deactivate_book_instance(book_instance_id):
 )
 @login_required
 def delete_book_instance(book_instance_id):
-    _book_instance = db_handlers.get_book_instance_by_id(book_instance_id)
-    if current_user.id != _book_instance.owner_id:
+    owner_id = db_handlers.get_book_instance_owner_id(book_instance_id)
+    if current_user.id != owner_id:
         return redirect(url_for('index'))
     db_handlers.delete_book_instance(book_instance_id)
+    utils.clear_map_cache()
     return redirect(request.referrer)
 
 
@@ -590,15 +779,13 @@ def send_message(recipient, prev_message_id):
         prev_message = db_handlers.get_message(prev_message_id)
 
     if form.validate_on_submit():
-        msg = Message(
-            book_instance_id=prev_message.book_instance_id,
-            book_id=prev_message.book_id,
-            author=current_user,
-            recipient=_user,
+        db_handlers.create_message(
+            sender_id=current_user.id,
+            recipient_id=_user.id,
             body=form.message.data,
+            book_id=prev_message.book_id,
+            book_instance_id=prev_message.book_instance_id,
         )
-        db.session.add(msg)
-        db.session.commit()
 
         # send email nofication to msg recipient
         recipient_email = (db_handlers.get_user_by_id(prev_message.sender_id)
@@ -641,11 +828,29 @@ def delete_message(message_id):
 @login_required
 def messages():
     current_user.last_message_read_time = datetime.utcnow()
+    current_user.unread_messages = 0
     db.session.commit()
-    _messages = db_handlers.get_messages_by_user(current_user.id)
+    before = None
+    before_id = request.args.get('before_id', type=int)
+    if before_id is not None:
+        try:
+            before = (datetime.fromisoformat(request.args['before_ts']),
+                      before_id)
+        except (KeyError, ValueError):
+            pass  # broken cursor, show the newest messages
+    _messages, older = db_handlers.get_messages_by_user(
+        current_user.id,
+        before=before,
+        limit=current_app.config['MESSAGES_PER_PAGE'],
+    )
+    older_url = None
+    if older is not None:
+        older_url = url_for('messages', before_ts=older[0].isoformat(),
+                            before_id=older[1])
     return render_template(
         'messages.html',
         messages=_messages,
+        older_url=older_url,
         form=MessageForm,
         basedir=current_app.config['BASEDIR'],
     )
@@ -0,0 +1,405 @@
+import bisect
+import heapq
+import math
+import re
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Dict, Iterable, List, Tuple
+
+from .models import Book
+from .replica import primary
+
+'''
+In-memory search index over Book.title & Book.author.
+
+Replaces LIKE '%kw%' scans in get_books_by_kw(). Each word of a book title or
+author is a token, every token points to the list of book ids that contain it
+(inverted index). A query is split the same way, so any subset of the query
+words gives a match: ' rssr Hamlet William' finds Hamlet, 'rssr' is ignored.
+
+Results are ranked by the sum of IDF weights of matched tokens, i.e. rare words
+(author surname) weigh more than common ones ('the', 'of').
+
+The index is built lazily on the first search and then kept up to date by
+sync(): only rows with Book.updated_at >= the latest indexed one (minus
+SYNC_OVERLAP for transactions committed late) are read, so it's cheap to call
+it on every search and after create_book. New and edited books and changed
+instance counters are picked up whichever worker has written them: an edited
+book is re-indexed if its words have changed. Deleted books are removed by
+purge() when a search finds them missing in DB (see get_books_by_kw).
+sync() and purge() always read the primary DB, a lagging replica would make
+the index miss the changes.
+
+Typos ('Dostoyevsky' vs 'Dostoevsky') are handled by trigram similarity: every
+token of the vocabulary is indexed by its trigrams, so an unknown query word is
+replaced by known words with similarity >= threshold (same measure as
+PostgreSQL pg_trgm: shared trigrams / all trigrams). Only tokens sharing at
+least one trigram with the query word are compared, books are not scanned.
+
+Search-as-you-type (suggest()) uses the sorted list of all tokens: tokens
+starting with a prefix are a contiguous slice found with bisect. Suggestions
+are ranked by Book.instance_counter, which is kept in memory and refreshed by
+sync() (changing the counter bumps Book.updated_at). A short prefix ('a',
+'th') matches a big part of the catalog, so the books of the prefix tokens
+aren't scanned: each token keeps its SUGGEST_TOP_K best books (made on the
+first use, then kept exact as counters change), the best books of the prefix
+are among the best books of its tokens. Prefixes of SUGGEST_PREFIX_LENGTH
+chars at most keep their best books too. See bench.bench_suggest().
+'''
+
+# sync() re-reads the books updated this time before the latest indexed one:
+# updated_at is set before commit, a long transaction may commit it later.
+SYNC_OVERLAP = timedelta(seconds=60)
+
+# Best books kept per token / prefix for suggest(), max number of suggestions
+SUGGEST_TOP_K = 50
+# Prefixes up to this length keep their best books as well: they match too
+# many tokens to merge the tokens best books on every keystroke.
+SUGGEST_PREFIX_LENGTH = 3
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """ Returns list of normalized (lowercase) words of the text """
+    if not text:
+        return []
+    return TOKEN_RE.findall(text.lower())
+
+
+def trigrams(token: str) -> set:
+    """ Returns set of the token trigrams, padded the same way as pg_trgm """
+    padded = '  ' + token + ' '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchIndex:
+
+    def __init__(self):
+        self._postings: Dict[str, List[int]] = dict()
+        self._trigrams: Dict[str, List[str]] = dict()
+        self._trigrams_count: Dict[str, int] = dict()
+        self._sorted_tokens: List[str] = []
+        self._counters: Dict[int, int] = dict()
+        # tokens of each indexed book, to re-index / remove it
+        self._book_tokens: Dict[int, Tuple[str, ...]] = dict()
+        # token / short prefix -> its best books by _rank (SUGGEST_TOP_K at
+        # most): exact top of the books, made when it's needed first
+        self._token_top: Dict[str, List[int]] = dict()
+        self._prefix_top: Dict[str, List[int]] = dict()
+        # short prefix -> number of the books with a token starting with it
+        self._prefix_books: Dict[str, int] = dict()
+        self._updated_at: datetime = None  # the latest indexed Book.updated_at
+        self._lock = Lock()
+
+    def _index(
+            self,
+            book_id: int,
+            title: str,
+            author: str,
+            instance_counter: int) -> Tuple[List[str], List[str]]:
+        """ Add (or re-index) the book, returns lists of the tokens
+        added to / removed from the vocabulary
+        """
+        tokens = tuple(sorted(set(tokenize(title) + tokenize(author))))
+        old_tokens = self._book_tokens.get(book_id)
+        kept_tokens = set(old_tokens or ()) & set(tokens)
+        self._set_counter(book_id, instance_counter or 0, kept_tokens)
+        if tokens == old_tokens:
+            return [], []
+        old_tokens = old_tokens or ()
+        removed_tokens = self._unindex(book_id, set(old_tokens) - set(tokens))
+        new_tokens = []
+        for token in set(tokens) - set(old_tokens):
+            if token not in self._postings:
+                new_tokens.append(token)
+                self._postings[token] = []
+                token_trigrams = trigrams(token)
+                self._trigrams_count[token] = len(token_trigrams)
+                for trigram in token_trigrams:
+                    self._trigrams.setdefault(trigram, []).append(token)
+            self._postings[token].append(book_id)
+            self._update_top(self._token_top.get(token),
+                             len(self._postings[token]), book_id)
+        for prefix in _prefixes(tokens) - _prefixes(kept_tokens):
+            count = self._prefix_books[prefix] = (
+                self._prefix_books.get(prefix, 0) + 1)
+            self._update_top(self._prefix_top.get(prefix), count, book_id)
+        self._book_tokens[book_id] = tokens
+        return new_tokens, removed_tokens
+
+    def _rank(self, book_id: int) -> Tuple[int, int]:
+        """ Sort key of suggestions: more instances first, then by id """
+        return -self._counters.get(book_id, 0), book_id
+
+    def _set_counter(
+            self,
+            book_id: int,
+            instance_counter: int,
+            tokens: Iterable[str]) -> None:
+        """ Set the book counter, update the top books of its tokens and
+        their prefixes
+        """
+        old_counter = self._counters.get(book_id)
+        self._counters[book_id] = instance_counter
+        if old_counter is None or old_counter == instance_counter:
+            return
+        is_worse = instance_counter < old_counter
+        for token in tokens:
+            self._update_top(self._token_top.get(token),
+                             len(self._postings[token]), book_id, is_worse)
+        for prefix in _prefixes(tokens):
+            self._update_top(self._prefix_top.get(prefix),
+                             self._prefix_books[prefix], book_id, is_worse)
+
+    def _update_top(
+            self,
+            top: List[int],
+            count: int,
+            book_id: int,
+            is_worse: bool = False) -> None:
+        """ Keep the top books of a token / prefix exact after the book is
+        added to it or the book rank has changed (is_worse - moved down).
+        count - number of the token / prefix books.
+        """
+        if not top:  # not made yet or emptied, made again when needed
+            return
+        if book_id in top:
+            top.sort(key=self._rank)
+            # the books out of the top may go before it now
+            if is_worse and top[-1] == book_id and len(top) < count:
+                top.pop()
+            return
+        # all the other books are in the top, or it goes before the last one
+        if (len(top) == count - 1
+                or self._rank(book_id) < self._rank(top[-1])):
+            top.insert(bisect.bisect_left([self._rank(i) for i in top],
+                                          self._rank(book_id)), book_id)
+            del top[SUGGEST_TOP_K:]
+
+    def _top_books(self, token: str, limit: int) -> List[int]:
+        """ Returns `limit` best books of the token (unsorted if the token
+        has not more books)
+        """
+        postings = self._postings[token]
+        if len(postings) <= limit:
+            return postings
+        top = self._token_top.get(token)
+        if top is None or len(top) < limit:
+            top = self._token_top[token] = heapq.nsmallest(
+                SUGGEST_TOP_K, postings, key=self._rank)
+        return top[:limit]
+
+    def _top_prefix_books(self, prefix: str, limit: int) -> List[int]:
+        """ Returns `limit` best books having a token starting with the
+        prefix, most instances first
+        """
+        top = self._prefix_top.get(prefix)
+        count = self._prefix_books.get(prefix, 0)
+        if top is None or len(top) < min(limit, count):
+            candidates = set()
+            for token in self._prefix_tokens(prefix):
+                candidates.update(self._top_books(token, SUGGEST_TOP_K))
+            top = heapq.nsmallest(SUGGEST_TOP_K, candidates, key=self._rank)
+            if len(prefix) <= SUGGEST_PREFIX_LENGTH:
+                self._prefix_top[prefix] = top
+        return top[:limit]
+
+    def _unindex(self, book_id: int, tokens: Iterable[str]) -> List[str]:
+        """ Remove the book from postings of the tokens (and their prefixes
+        the book has no other tokens with), returns list of the tokens
+        removed from the vocabulary (no books left)
+        """
+        tokens = set(tokens)
+        kept_tokens = set(self._book_tokens.get(book_id, ())) - tokens
+        for prefix in _prefixes(tokens) - _prefixes(kept_tokens):
+            self._prefix_books[prefix] -= 1
+            top = self._prefix_top.get(prefix)
+            if top and book_id in top:
+                top.remove(book_id)
+            if not self._prefix_books[prefix]:
+                del self._prefix_books[prefix]
+                self._prefix_top.pop(prefix, None)
+        removed_tokens = []
+        for token in tokens:
+            postings = self._postings[token]
+            postings.remove(book_id)
+            top = self._token_top.get(token)
+            if top and book_id in top:
+                top.remove(book_id)
+            if postings:
+                continue
+            removed_tokens.append(token)
+            del self._postings[token]
+            self._token_top.pop(token, None)
+            del self._trigrams_count[token]
+            for trigram in trigrams(token):
+                self._trigrams[trigram].remove(token)
+                if not self._trigrams[trigram]:
+                    del self._trigrams[trigram]
+        return removed_tokens
+
+    def _update_sorted_tokens(
+            self,
+            new_tokens: List[str],
+            removed_tokens: List[str]) -> None:
+        if len(new_tokens) + len(removed_tokens) > 100:
+            self._sorted_tokens = sorted(self._postings)
+            return
+        for token in removed_tokens:
+            del self._sorted_tokens[
+                bisect.bisect_left(self._sorted_tokens, token)]
+        for token in new_tokens:
+            bisect.insort(self._sorted_tokens, token)
+
+    @property
+    def _books_total(self) -> int:
+        return len(self._book_tokens)
+
+    def sync(self, chunk_size: int = 10000) -> None:
+        """ Index the books created / updated since the last sync """
+        with self._lock, primary():
+            books = Book.query.with_entities(
+                Book.id, Book.title, Book.author, Book.instance_counter,
+                Book.updated_at)
+            if self._updated_at is not None:
+                books = books.filter(
+                    Book.updated_at >= self._updated_at - SYNC_OVERLAP)
+            new_tokens, removed_tokens = [], []
+            for book_id, title, author, instance_counter, updated_at in (
+                    books.yield_per(chunk_size)):
+                added, removed = self._index(book_id, title, author,
+                                             instance_counter)
+                new_tokens += added
+                removed_tokens += removed
+                if updated_at and (self._updated_at is None
+                                   or updated_at > self._updated_at):
+                    self._updated_at = updated_at
+            self._update_sorted_tokens(new_tokens, removed_tokens)
+
+    def purge(self, book_ids: Iterable[int]) -> None:
+        """ Remove the books from the index if they are deleted from DB """
+        book_ids = [i for i in book_ids if i in self._book_tokens]
+        if not book_ids:
+            return
+        with self._lock, primary():
+            existing = {book_id for book_id, in Book.query
+                        .with_entities(Book.id)
+                        .filter(Book.id.in_(book_ids))}
+            removed_tokens = []
+            for book_id in set(book_ids) - existing:
+                removed_tokens += self._unindex(
+                    book_id, self._book_tokens.pop(book_id))
+                self._counters.pop(book_id, None)
+            self._update_sorted_tokens([], removed_tokens)
+
+    def similar_tokens(
+            self,
+            token: str,
+            threshold: float) -> List[Tuple[str, float]]:
+        """ Returns known tokens similar to the token with their similarity """
+        token_trigrams = trigrams(token)
+        shared: Dict[str, int] = dict()
+        for trigram in token_trigrams:
+            for candidate in self._trigrams.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+        similar = []
+        for candidate, common in shared.items():
+            union = (len(token_trigrams) + self._trigrams_count[candidate]
+                     - common)
+            similarity = common / union
+            if similarity >= threshold:
+                similar.append((candidate, similarity))
+        return similar
+
+    def search(
+            self,
+            query: str,
+            limit: int = 100,
+            threshold: float = 0.3) -> List[int]:
+        """ Returns ids of the books matched any of query words.
+        Most relevant go first.
+
+        Unknown query words are matched to similar known words
+        (trigram similarity >= threshold), set threshold=1 to switch it off.
+        """
+        self.sync()
+        scores: Dict[int, float] = dict()
+        for query_token in set(tokenize(query)):
+            if query_token in self._postings:
+                matches = [(query_token, 1.0)]
+            else:
+                matches = self.similar_tokens(query_token, threshold)
+            for token, similarity in matches:
+                book_ids = self._postings[token]
+                idf = math.log(1 + self._books_total / len(book_ids))
+                for book_id in book_ids:
+                    scores[book_id] = (scores.get(book_id, 0)
+                                       + idf * similarity)
+        return [book_id for book_id, _ in _top(scores.items(), limit)]
+
+    def _prefix_tokens(self, prefix: str) -> List[str]:
+        start = bisect.bisect_left(self._sorted_tokens, prefix)
+        end = bisect.bisect_left(self._sorted_tokens, prefix + '\uffff')
+        return self._sorted_tokens[start:end]
+
+    def suggest(self, query: str, limit: int = 10) -> List[int]:
+        """ Returns ids of the books for search-as-you-type,
+        SUGGEST_TOP_K at most.
+
+        All query words but the last have to match exactly, the last one is
+        treated as a prefix. The books with more instances go first.
+        """
+        self.sync()
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+        *words, prefix = query_tokens
+        limit = min(limit, SUGGEST_TOP_K)
+        prefix_tokens = self._prefix_tokens(prefix)
+
+        if not words:
+            return self._top_prefix_books(prefix, limit)
+
+        # the books have all the words: the best books of the rarest word are
+        # enough if `limit` of them match, check all the books of the rarest
+        # word or of the prefix (whichever are less) otherwise
+        words, prefix_tokens = set(words), set(prefix_tokens)
+        book_tokens = self._book_tokens
+
+        def matches(book_ids: Iterable[int]) -> List[int]:
+            return [book_id for book_id in book_ids
+                    if words.issubset(book_tokens[book_id])
+                    and not prefix_tokens.isdisjoint(book_tokens[book_id])]
+
+        if not all(word in self._postings for word in words):
+            return []
+        rarest = min(words, key=lambda word: len(self._postings[word]))
+        books = self._postings[rarest]
+        if len(books) > SUGGEST_TOP_K:
+            candidates = matches(self._top_books(rarest, SUGGEST_TOP_K))
+            if len(candidates) >= limit:
+                return candidates[:limit]
+        prefix_books = 0
+        for token in prefix_tokens:
+            prefix_books += len(self._postings[token])
+            if prefix_books >= len(books):
+                break
+        else:
+            books = {book_id for token in prefix_tokens
+                     for book_id in self._postings[token]}
+        return heapq.nsmallest(limit, matches(books), key=self._rank)
+
+
+def _prefixes(tokens: Iterable[str]) -> set:
+    """ Returns set of the tokens prefixes, SUGGEST_PREFIX_LENGTH at most """
+    return {token[:length] for token in tokens
+            for length in range(1, min(len(token), SUGGEST_PREFIX_LENGTH) + 1)}
+
+
+def _top(items: Iterable[Tuple[int, float]], limit: int):
+    """ Returns `limit` best items: by score desc, then by book_id asc """
+    return heapq.nsmallest(limit, items, key=lambda x: (-x[1], x[0]))
+
+
+book_index = SearchIndex()
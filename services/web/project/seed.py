@@ -0,0 +1,340 @@
+import csv
+import io
+from datetime import datetime, timedelta
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from sqlalchemy import and_, func, select
+
+from . import db
+from .geo import cell_id
+from .isbn import canonical_isbn, isbn_10_to_13
+from .models import Book, BookInstance, Message, User
+
+'''
+Synthetic dataset generator: fills DB with any number of users, books,
+book instances and messages (see manage.py seed_db).
+
+Rows are generated by numpy in batches of batch_size and written by bulk
+inserts (COPY on PostgreSQL, executemany on other DBs), so memory use doesn't
+depend on the dataset size. Ids are assigned here (continuing the existing
+ones), that's how instances and messages refer to users and books without
+reading them back.
+
+Distributions:
+ - users live around a few cities (the given one is the biggest), gaussian
+   spread of ~5 km around the city center
+ - book popularity is skewed: a few books have most of the instances
+ - prices are log-normal (median ~80), conditions are mostly 'good'
+ - instances are created during the last year, older ones are mostly expired
+ - messages are sent to instance owners by random users
+'''
+
+# (latitude, longitude, weight) of the other cities users live in
+CITIES = (
+    (49.9935, 36.2304, 0.5),  # Kharkiv
+    (46.4825, 30.7233, 0.35),  # Odesa
+    (48.4647, 35.0462, 0.35),  # Dnipro
+    (49.8397, 24.0297, 0.25),  # Lviv
+    (47.8388, 35.1396, 0.25),  # Zaporizhzhia
+)
+CITY_SPREAD = 0.05  # degrees, ~5 km
+CONDITION_WEIGHTS = (0.1, 0.25, 0.45, 0.2)  # conditions 1..4
+
+TITLE_WORDS = (
+    'Silent River Night Garden Shadow Winter Secret House Stone Fire Last '
+    'Road Sea Light Lost Time War Peace Dream City Storm Golden Heart Empire '
+    'Song Forest Moon Iron Glass Crown Hidden Blue Dark Long Summer Voice '
+    'Island Mountain Letters Bridge Kingdom Wild Journey Memory Daughter '
+    'King Stranger Orchard Harbor Frost Ashes Silver Ghost Captain Clockwork '
+    'Whisper Thunder Lantern Mirror Winds Tide Ember Raven Meadow Castle'
+).split()
+FIRST_NAMES = (
+    'Anna Ivan Olena Taras Maria Petro Iryna Mykola Sofia Andriy John Jane '
+    'Emily George Lev Fyodor Virginia Ernest Agatha Mark Lesya Vasyl Ray '
+    'Ursula Terry Neil Margaret Isaac Arthur Doris'
+).split()
+LAST_NAMES = (
+    'Shevchenko Franko Ukrainka Kotsiubynsky Tolstoy Dostoevsky Woolf '
+    'Hemingway Christie Twain Orwell Austen Bradbury Le_Guin Pratchett Gaiman '
+    'Atwood Asimov Clarke Lessing Zhadan Andrukhovych Kostenko Stus Hrabal '
+    'Kundera Murakami Eco Calvino Borges Marquez Nabokov Bulgakov Chekhov'
+).replace('_', ' ').split()
+
+
+def isbn_13(number: int) -> int:
+    """ Returns valid (check digit) ISBN-13 978xxxxxxxxxc made of number """
+    return isbn_10_to_13(str(number % 10 ** 9).zfill(9))
+
+
+def _next_id(model) -> int:
+    return (db.session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def _batches(total: int, batch_size: int) -> Iterator[Tuple[int, int]]:
+    """ Yields (offset, size) of the batches """
+    for offset in range(0, total, batch_size):
+        yield offset, min(batch_size, total - offset)
+
+
+def _insert(table, rows: List[dict]) -> None:
+    """ Bulk insert rows (dicts with the same keys) into the table """
+    if not rows:
+        return
+    if db.engine.dialect.name != 'postgresql':
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), rows)
+        return
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+    raw_connection = db.engine.raw_connection()
+    try:
+        cursor = raw_connection.cursor()
+        cursor.copy_expert(
+            f'COPY "{table.name}" ({", ".join(columns)}) FROM STDIN WITH CSV',
+            buffer)
+        raw_connection.commit()
+    finally:
+        raw_connection.close()
+
+
+def _reset_sequences(*models) -> None:
+    """ Ids were inserted explicitly, move PostgreSQL sequences past them """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in models:
+        table = model.__table__.name
+        db.session.execute(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f"(SELECT max(id) FROM \"{table}\"))")
+    db.session.commit()
+
+
+def _timestamps(now: datetime, seconds_ago: np.ndarray) -> List[datetime]:
+    return [now - timedelta(seconds=int(s)) for s in seconds_ago]
+
+
+def _generate_users(
+        rng,
+        users: int,
+        batch_size: int,
+        latitude: float,
+        longitude: float) -> Tuple[int, int]:
+    """ Returns (first id, last id) of the generated users """
+    cities = np.array(((latitude, longitude, 1.0),) + CITIES)
+    weights = cities[:, 2] / cities[:, 2].sum()
+    first_id = _next_id(User)
+    now = datetime.utcnow()
+    for offset, size in _batches(users, batch_size):
+        city = rng.choice(len(cities), size=size, p=weights)
+        latitudes = cities[city, 0] + rng.normal(0, CITY_SPREAD, size)
+        longitudes = cities[city, 1] + rng.normal(0, CITY_SPREAD, size)
+        created = _timestamps(now, rng.integers(0, 730 * 86400, size))
+        seen = _timestamps(now, rng.exponential(14 * 86400, size))
+        rows = []
+        for i in range(size):
+            user_id = first_id + offset + i
+            user_latitude = round(float(latitudes[i]), 6)
+            user_longitude = round(float(longitudes[i]), 6)
+            rows.append({
+                'id': user_id,
+                'username': f'user_{user_id}',
+                'email': f'user_{user_id}@gmail.com',
+                'avatar': None,
+                'is_active': True,
+                'is_admin': False,
+                'timestamp': created[i],
+                'latitude': user_latitude,
+                'longitude': user_longitude,
+                'geo_cell': cell_id(user_latitude, user_longitude),
+                'about_me': 'No info about the user yet.',
+                'last_seen': max(created[i], seen[i]),
+                'last_message_read_time': datetime(1900, 1, 1),
+                'unread_messages': 0,
+            })
+        _insert(User.__table__, rows)
+    return first_id, first_id + users - 1
+
+
+def _generate_books(
+        rng,
+        books: int,
+        batch_size: int,
+        users_range: Tuple[int, int],
+        filepath: str = None) -> Tuple[int, int]:
+    """ Returns (first id, last id) of the generated books. The first ones
+    are taken from the *.csv file (title, author, isbn_13) if it's given.
+    """
+    examples = []
+    if filepath:
+        with open(filepath, newline='') as csvfile:
+            book_reader = csv.reader(csvfile, delimiter=',', quotechar="'")
+            examples = [(title, author, int(isbn))
+                        for title, author, isbn in book_reader]
+    first_id = _next_id(Book)
+    now = datetime.utcnow()
+    for offset, size in _batches(books, batch_size):
+        words = rng.integers(0, len(TITLE_WORDS), (size, 4))
+        title_lengths = rng.integers(2, 5, size)
+        first_names = rng.integers(0, len(FIRST_NAMES), size)
+        last_names = rng.integers(0, len(LAST_NAMES), size)
+        creators = (rng.integers(users_range[0], users_range[1] + 1, size)
+                    if users_range[1] >= users_range[0] else [None] * size)
+        created = _timestamps(now, rng.integers(0, 730 * 86400, size))
+        rows = []
+        for i in range(size):
+            book_id = first_id + offset + i
+            if offset + i < len(examples):
+                title, author, isbn = examples[offset + i]
+                creator = None
+            else:
+                title = ' '.join(TITLE_WORDS[w]
+                                 for w in words[i, :title_lengths[i]])
+                author = (f'{FIRST_NAMES[first_names[i]]} '
+                          f'{LAST_NAMES[last_names[i]]}')
+                isbn = isbn_13(book_id)
+                creator = creators[i] and int(creators[i])
+            rows.append({
+                'id': book_id,
+                'isbn': canonical_isbn(isbn),
+                'isbn_10': None,
+                'isbn_13': isbn,
+                'title': title,
+                'author': author,
+                'created_by': creator,
+                'timestamp': created[i],
+                'updated_at': now,
+                'instance_counter': 0,
+            })
+        # ISBNs already in DB (one query per batch), keep them unique
+        existing = {isbn for isbn, in db.session.query(Book.isbn).filter(
+            Book.isbn.in_([row['isbn'] for row in rows if row['isbn']]))}
+        for row in rows:
+            if row['isbn'] in existing:
+                row['isbn'] = None
+        _insert(Book.__table__, rows)
+    return first_id, first_id + books - 1
+
+
+def _generate_book_instances(
+        rng,
+        book_instances: int,
+        messages: int,
+        batch_size: int,
+        users_range: Tuple[int, int],
+        books_range: Tuple[int, int]) -> None:
+    """ Generates book instances and messages about them """
+    users_first, users_last = users_range
+    users_total = users_last - users_first + 1
+    books_first, books_last = books_range
+    books_total = books_last - books_first + 1
+    first_id = _next_id(BookInstance)
+    now = datetime.utcnow()
+    messages_left = messages
+    for offset, size in _batches(book_instances, batch_size):
+        # popular books first: P(book index < x * books) = x ** (1/3)
+        book_ids = books_first + (
+            books_total * rng.random(size) ** 3).astype(int)
+        owner_ids = rng.integers(users_first, users_last + 1, size)
+        prices = np.clip(
+            np.round(rng.lognormal(np.log(80), 0.6, size)), 10, 5000)
+        conditions = rng.choice(4, size=size, p=CONDITION_WEIGHTS) + 1
+        seconds_ago = rng.integers(0, 365 * 86400, size)
+        # fresh instances are active, older ones are mostly expired
+        is_active = rng.random(size) < np.where(
+            seconds_ago < 30 * 86400, 0.95, 0.2)
+        created = _timestamps(now, seconds_ago)
+        _insert(BookInstance.__table__, [{
+            'id': first_id + offset + i,
+            'price': int(prices[i]),
+            'condition': int(conditions[i]),
+            'description': 'Lorem ipsum...',
+            'owner_id': int(owner_ids[i]),
+            'book_id': int(book_ids[i]),
+            'is_active': bool(is_active[i]),
+            'timestamp': created[i],
+        } for i in range(size)])
+
+        # messages of the batch, proportional to its size
+        batch_messages = min(messages_left,
+                             -(-messages * size // book_instances))
+        messages_left -= batch_messages
+        about = rng.integers(0, size, batch_messages)
+        # any user but the owner
+        senders = users_first + (
+            owner_ids[about] - users_first
+            + rng.integers(1, max(users_total, 2), batch_messages)
+        ) % users_total
+        sent_after = rng.exponential(3 * 86400, batch_messages)
+        _insert(Message.__table__, [{
+            'book_id': int(book_ids[j]),
+            'book_instance_id': first_id + offset + int(j),
+            'sender_id': int(senders[i]),
+            'recipient_id': int(owner_ids[j]),
+            'exists_for_sender': 1,
+            'exists_for_recipient': 1,
+            'body': 'Hi! Is the book still available?',
+            'timestamp': min(created[j] + timedelta(seconds=int(sent_after[i])),
+                             now),
+        } for i, j in enumerate(about)])
+
+
+def update_instance_counters() -> None:
+    """ Set Book.instance_counter to real number of book instances """
+    counts = (select([func.count()])
+              .where(BookInstance.book_id == Book.id)
+              .as_scalar())
+    (db.session.query(Book)
+     .update({Book.instance_counter: counts}, synchronize_session=False))
+    db.session.commit()
+
+
+def update_unread_counters() -> None:
+    """ Set User.unread_messages to real number of new messages """
+    counts = (select([func.count()])
+              .where(and_(Message.recipient_id == User.id,
+                          Message.timestamp > func.coalesce(
+                              User.last_message_read_time,
+                              datetime(1900, 1, 1))))
+              .as_scalar())
+    (db.session.query(User)
+     .update({User.unread_messages: counts}, synchronize_session=False))
+    db.session.commit()
+
+
+def generate(
+        users: int = 15,
+        books: int = 15,
+        book_instances: int = 60,
+        messages: int = 0,
+        batch_size: int = 10000,
+        seed: int = None,
+        latitude: float = 50.4547,
+        longitude: float = 30.520,
+        filepath: str = None) -> None:
+    """ Fill DB with synthetic Users, Books, BookInstances, Messages
+    Args:
+     - users, books, book_instances, messages: how many to generate
+     - batch_size: rows per insert, the memory use is proportional to it
+     - seed: random seed, the same seed gives the same data
+     - latitude, longitude: the biggest city, users live around it and
+       a few other cities
+     - filepath: *.csv file (title, author, isbn_13) of the first books
+    """
+    rng = np.random.default_rng(seed)
+    if not users or not books:
+        book_instances = messages = 0
+    users_range = _generate_users(rng, users, batch_size, latitude, longitude)
+    books_range = _generate_books(rng, books, batch_size, users_range,
+                                  filepath)
+    if book_instances:
+        _generate_book_instances(rng, book_instances, messages, batch_size,
+                                 users_range, books_range)
+    _reset_sequences(User, Book, BookInstance)
+    update_instance_counters()
+    if messages:
+        update_unread_counters()
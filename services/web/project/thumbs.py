@@ -1,13 +1,22 @@
 import os
-from PIL import Image
+import tempfile
+
+from PIL import Image, ImageOps
 
 '''
 The file is used for image transformation: horisontal/vertical scale, crop
 
 Currently only 1 of 3 mode ('crop') is used in the app.
 Not sure that it's reasonably to delete other two modes. May need it later.
+
+The image is decoded once: JPEG in draft mode, i.e. already reduced by the
+decoder (1/2, 1/4, 1/8 scale) to the smallest size still not less than the
+target one, so a 12 Mpx phone photo never gets into memory in full.
 '''
 
+EXIF_ORIENTATION = 0x0112
+ROTATED_ORIENTATIONS = (5, 6, 7, 8)  # width & height are swapped
+
 SCALE_WIDTH = 'w'
 SCALE_HEIGHT = 'h'
 SCALE_BOTH = 'crop'
@@ -18,19 +27,19 @@ def crop(img, x, y):
     img_ratio = img_x / float(img_y)
     crop_ratio = x / float(y)
     if crop_ratio == img_ratio:
-        img.thumbnail([x, y], Image.ANTIALIAS)
+        img.thumbnail([x, y], Image.LANCZOS)
         return img
 
     if crop_ratio < img_ratio:
         scale_factor = img_y / float(y)
-        img.thumbnail([int(img_x / scale_factor) + 1, y], Image.ANTIALIAS)
+        img.thumbnail([int(img_x / scale_factor) + 1, y], Image.LANCZOS)
         img_x, img_y = img.size
         x_offset = (img_x - x) / 2
         return img.crop([x_offset, 0, x_offset + x, y])
 
     if crop_ratio > img_ratio:
         scale_factor = img_x / float(x)
-        img.thumbnail([x, int(img_y / scale_factor) + 1], Image.ANTIALIAS)
+        img.thumbnail([x, int(img_y / scale_factor) + 1], Image.LANCZOS)
         img_x, img_y = img.size
         y_offset = (img_y - y) / 2
         return img.crop([0, y_offset, x, y_offset + y])
@@ -42,17 +51,29 @@ def scale(max_x, pair):
     return (int(max_x), int(new_y))
 
 
-def thumbnail(filename: str, size='200w'):
+def _draft(image, x: int, y: int, orientation: int) -> None:
+    """ Let JPEG decoder reduce the image to not less than x * y
+    (as it's shown, i.e. after EXIF rotation)
+    """
+    if image.format != 'JPEG':
+        return
+    if orientation in ROTATED_ORIENTATIONS:
+        x, y = y, x
+    image.draft('RGB', (x, y))
+
+
+def thumbnail(fp, size='200w'):
     ''' Returns shrinkened/cropped image
 
-    image - image
+    fp - filename or file object (e.g. uploaded file stream)
     size - sting. Has 3 options:
         resize by target HEIGHTS, for example: '50H' (50 pixels height)
         resize by target WIDTH, for example: '50W'
         resize by target HEIGHTS & WIDTH, for example: '50x150'
 
     If crop needed to fit H&W, the image is cropped centered (cutoff from both
-    sides)
+    sides). The image is rotated according to its EXIF orientation and
+    converted to RGB, i.e. it can be saved as JPEG.
 
     Example (by target HEIGHTS & WIDTH case):
     pic = thumbnail(filepath, str(image_width)+'x'+str(image_height))
@@ -69,20 +90,86 @@ def thumbnail(filename: str, size='200w'):
     else:
         mode = 'crop'
 
-    # if the image wasn't already resized, resize it
-    image = Image.open(filename)
+    image = Image.open(fp)
+    orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+
+    if mode == SCALE_HEIGHT:
+        _draft(image, 1, max_size, orientation)
+    elif mode == SCALE_WIDTH:
+        _draft(image, max_size, 1, orientation)
+    elif mode == SCALE_BOTH:
+        x, y = [int(i) for i in size.split('x')]
+        _draft(image, x, y, orientation)
+    else:
+        raise Exception("Thumbnail size must be in ##w, ##h, or ##x## format.")
 
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
     image_x, image_y = image.size
 
     if mode == SCALE_HEIGHT:
         image_y, image_x = scale(max_size, (image_y, image_x))
-        image.thumbnail([image_x, image_y], Image.ANTIALIAS)
+        image.thumbnail([image_x, image_y], Image.LANCZOS)
     elif mode == SCALE_WIDTH:
         image_x, image_y = scale(max_size, (image_x, image_y))
-        image.thumbnail([image_x, image_y], Image.ANTIALIAS)
-    elif mode == SCALE_BOTH:
-        x, y = [int(i) for i in size.split('x')]
-        image = crop(image, x, y)
+        image.thumbnail([image_x, image_y], Image.LANCZOS)
     else:
-        raise Exception("Thumbnail size must be in ##w, ##h, or ##x## format.")
+        image = crop(image, x, y)
     return image
+
+
+def variants(image, sizes: dict) -> dict:
+    ''' Returns {name: image} of the image cropped to each of sizes
+
+    image - the biggest variant, e.g. result of thumbnail()
+    sizes - {name: '##x##'}, e.g. {'s': '50x70'}
+    '''
+    result = dict()
+    for name, size in sizes.items():
+        x, y = [int(i) for i in size.split('x')]
+        result[name] = crop(image.copy(), x, y)
+    return result
+
+
+def cover_filename(book_id, variant: str = '', extension: str = 'jpg') -> str:
+    ''' e.g. '12.jpg' (the cover), '12_s.webp' (its variant 's') '''
+    return f'{book_id}_{variant}.{extension}' if variant else \
+        f'{book_id}.{extension}'
+
+
+def _save_atomic(image, path: str, image_format: str, quality: int):
+    ''' Write the image to a temporary file, rename it to path '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, image_format, quality=quality)
+        os.chmod(tmp_path, 0o644)  # mkstemp makes it 0600, nginx serves it
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def save_cover_files(image, folder: str, book_id, sizes: dict, quality=85):
+    ''' Atomically write the cover image and its variants (see variants()),
+    each as JPEG & WebP, to the folder.
+    <book_id>.webp is written the last: the cover exists when all its
+    variants are there (see utils.has_cover()).
+    '''
+    images = variants(image, sizes)
+    images[''] = image
+    for variant, variant_image in images.items():
+        for extension, image_format in (('jpg', 'JPEG'), ('webp', 'WEBP')):
+            _save_atomic(variant_image, os.path.join(
+                folder, cover_filename(book_id, variant, extension)),
+                image_format, quality)
+
+
+def make_cover(fp, folder: str, book_id, size: str, sizes: dict, quality=85):
+    ''' Cover of the image: thumbnail(fp, size) with its variants, saved
+    to the folder (see save_cover_files()).
+    Doesn't need the app, i.e. can be run in another process.
+    '''
+    save_cover_files(thumbnail(fp, size), folder, book_id, sizes, quality)
@@ -1,17 +1,30 @@
 import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import List, Tuple, Union
 
 import folium
-import folium.plugins
 import ipapi
-from flask import current_app
+import numpy as np
+from flask import current_app, render_template, url_for
 from flask_login import current_user
+from PIL import Image
 
+from . import app
+from .clusters import cluster_index
 from .db_handlers import (book_counter_created_by_user,
-                          deactivate_any_bi_if_expired,
-                          get_expired_bi_with_users,
-                          get_user_by_id)
+                          deactivate_book_instances,
+                          get_active_bi_locations,
+                          get_analytics,
+                          get_expired_bi_chunk,
+                          rebuild_clusters,
+                          rollup_daily_stats,
+                          trim_fresh_listings)
 from .email import send_email_bi_is_expired
-from .models import Book
+from .geo import haversine_np
+from .thumbs import cover_filename, save_cover_files, thumbnail
 
 ipapi.location(ip=None, key=None, field=None)
 
@@ -28,91 +41,353 @@ def has_allowed_filesize(obj, filesize_name) -> bool:
 
 
 def cover_upload(cover, book_id) -> int:
-    """ Upload file w/o checking size """
-    filename = str(book_id) + '.jpg'
-    if has_allowed_filesize(cover, 'MAX_IMAGE_FILESIZE'):
-        try:
-            cover.save(
-                os.path.join(current_app.config["IMAGE_UPLOADS"], filename)
-            )
-        except FileExistsError:
-            return 1
+    """ Saves the cover thumbnail (IMAGE_TARGET_SIZE) of the uploaded image
+    with its size variants, see save_cover(). The upload is processed in
+    memory and every file is written once: to a temporary file, renamed to
+    the final path, so the cover is never seen half-written.
+    Args:
+     - cover: uploaded file (FileStorage) or any file object / filename
+    Returns 0 if the cover is saved, 1 if it isn't an image.
+    """
+    if not has_allowed_filesize(cover, 'MAX_IMAGE_FILESIZE'):
+        return 0
+    try:
+        image = thumbnail(
+            getattr(cover, 'stream', cover),
+            current_app.config["IMAGE_TARGET_SIZE"],
+        )
+    except (OSError, SyntaxError, ValueError,  # not an image / truncated
+            Image.DecompressionBombError):  # too many pixels
+        return 1
+    save_cover(image, book_id)
     return 0
 
 
+@app.template_global()
+def cover_url(book_id, variant: str = '', extension: str = 'jpg') -> str:
+    """ URL of the book cover variant, the default cover if the book has
+    no own one (w/o filesystem access)
+    """
+    return '/static/covers/' + cover_filename(
+        get_cover_id(book_id), variant, extension)
+
+
+def save_cover(image, book_id) -> None:
+    """ Atomically write the cover image (IMAGE_TARGET_SIZE) and its
+    COVER_VARIANTS, each as JPEG & WebP, to IMAGE_UPLOADS
+    """
+    save_cover_files(
+        image,
+        current_app.config["IMAGE_UPLOADS"],
+        book_id,
+        current_app.config['COVER_VARIANTS'],
+        current_app.config['COVER_QUALITY'],
+    )
+    add_to_covers_manifest(book_id)
+
+
+def backfill_cover_variants(force: bool = False) -> int:
+    """ Make the variants of the covers in IMAGE_UPLOADS which have not them
+    yet (all the covers if force), returns number of the covers done.
+    """
+    folder = current_app.config["IMAGE_UPLOADS"]
+    filenames = set(os.listdir(folder))
+    done = 0
+    for filename in sorted(filenames):
+        book_id, extension = os.path.splitext(filename)
+        if extension != '.jpg' or not book_id.isdigit():
+            continue
+        expected = [cover_filename(book_id, variant, 'webp')
+                    for variant in current_app.config['COVER_VARIANTS']]
+        expected.append(cover_filename(book_id, '', 'webp'))
+        if not force and all(name in filenames for name in expected):
+            continue
+        save_cover(thumbnail(os.path.join(folder, filename),
+                             current_app.config["IMAGE_TARGET_SIZE"]),
+                   int(book_id))
+        done += 1
+    return done
+
+
+# ids of the books which have a cover with all its variants in IMAGE_UPLOADS
+# dir, i.e. <book_id>.webp, written the last (see thumbs.save_cover_files):
+# legacy covers (<book_id>.jpg only) get the default cover until their
+# variants are made (backfill_cover_variants). Used instead of
+# os.path.exists() per cover, reloaded every COVERS_MANIFEST_TTL seconds to
+# see covers uploaded by other workers.
+_covers_manifest = set()
+_covers_manifest_expiration = 0.0
+
+
+def _load_covers_manifest() -> set:
+    global _covers_manifest, _covers_manifest_expiration
+    now = time.monotonic()
+    if now >= _covers_manifest_expiration:
+        manifest = set()
+        for filename in os.listdir(current_app.config["IMAGE_UPLOADS"]):
+            name, ext = os.path.splitext(filename)
+            if ext == '.webp' and name.isdigit():
+                manifest.add(int(name))
+        _covers_manifest = manifest
+        _covers_manifest_expiration = (
+            now + current_app.config['COVERS_MANIFEST_TTL'])
+    return _covers_manifest
+
+
+def has_cover(book_id) -> bool:
+    """ Checks if the book has its own cover (w/o filesystem access) """
+    return int(book_id) in _load_covers_manifest()
+
+
+def refresh_cover(book_id) -> bool:
+    """ Checks if the book cover with all its variants is saved, by the file,
+    and adds the book to the manifest if so: a cover made by another worker
+    is seen by this one's manifest up to COVERS_MANIFEST_TTL later.
+    """
+    exists = os.path.exists(os.path.join(
+        current_app.config["IMAGE_UPLOADS"],
+        cover_filename(book_id, '', 'webp')))
+    if exists:
+        add_to_covers_manifest(book_id)
+    return exists
+
+
+def get_cover_id(book_id) -> int:
+    """ Returns book_id if the book has a cover, else 0 (no-cover image) """
+    return int(book_id) if has_cover(book_id) else 0
+
+
+def add_to_covers_manifest(book_id) -> None:
+    _load_covers_manifest().add(int(book_id))
+
+
+# Rendered maps html, {key: (expiration_time, html)}. Key is built of
+# the map params (book ids, center), see _get_cached_map()
+_map_cache = OrderedDict()
+_map_cache_lock = Lock()
+
+
+def _get_cached_map(key, render) -> str:
+    """ Returns map html from the cache or renders it by render() call.
+    Least recently used maps are evicted when MAP_CACHE_SIZE is reached.
+    """
+    now = time.monotonic()
+    with _map_cache_lock:
+        cached = _map_cache.get(key)
+        if cached and cached[0] > now:
+            _map_cache.move_to_end(key)
+            return cached[1]
+
+    html = render()
+
+    with _map_cache_lock:
+        _map_cache[key] = (now + current_app.config['MAP_CACHE_TTL'], html)
+        _map_cache.move_to_end(key)
+        while len(_map_cache) > current_app.config['MAP_CACHE_SIZE']:
+            _map_cache.popitem(last=False)
+    return html
+
+
+def clear_map_cache() -> None:
+    """ Call it when book instances / users locations are changed """
+    with _map_cache_lock:
+        _map_cache.clear()
+
+
+_analytics_cache = {'expires': 0.0, 'stats': None}
+_analytics_cache_lock = Lock()
+
+
+def get_cached_analytics() -> dict:
+    """ Returns admin dashboard numbers (see db_handlers.get_analytics),
+    cached for ANALYTICS_CACHE_TTL seconds.
+    """
+    now = time.monotonic()
+    with _analytics_cache_lock:
+        if _analytics_cache['expires'] > now:
+            return _analytics_cache['stats']
+    stats = get_analytics(use_rollup=current_app.config['ANALYTICS_USE_ROLLUP'])
+    with _analytics_cache_lock:
+        _analytics_cache['stats'] = stats
+        _analytics_cache['expires'] = (
+            now + current_app.config['ANALYTICS_CACHE_TTL'])
+    return stats
+
+
+def rank_offers(
+        book_instances: list,
+        latitude: Union[float, None],
+        longitude: Union[float, None],
+        weights: dict,
+        page: int = 1,
+        per_page: int = 20) -> Tuple[List[dict], int]:
+    """ Sorts book instances (offers) by a blend of price, condition and
+    distance to the point, the best go first. Returns the page of offers
+    (dicts with additional 'distance' key, km) and number of pages.
+
+    Every criterion is scaled to 0..1 (0 - the cheapest / the best
+    condition / the nearest offer) and multiplied by its weight, e.g.
+    weights = {'price': 1.0, 'condition': 0.5, 'distance': 1.0}
+    """
+    if not book_instances:
+        return [], 0
+    pages = -(-len(book_instances) // per_page)
+
+    def _scaled(values: np.ndarray) -> np.ndarray:
+        spread = values.max() - values.min()
+        return (values - values.min()) / spread if spread else values * 0
+
+    prices = np.array([bi.price or 0 for bi in book_instances], dtype=float)
+    conditions = np.array(
+        [bi.condition or 0 for bi in book_instances], dtype=float)
+    score = (weights.get('price', 0) * _scaled(prices)
+             + weights.get('condition', 0) * _scaled(-conditions))
+
+    distances = None
+    if latitude is not None and longitude is not None:
+        latitudes = np.array([bi.latitude for bi in book_instances],
+                             dtype=float)
+        longitudes = np.array([bi.longitude for bi in book_instances],
+                              dtype=float)
+        distances = haversine_np(latitude, longitude, latitudes, longitudes)
+        # owners with no location are considered the farthest ones
+        is_known = ~np.isnan(distances)
+        farthest = distances[is_known].max() if is_known.any() else 0
+        distances_known = np.where(is_known, distances, farthest)
+        score += weights.get('distance', 0) * _scaled(distances_known)
+
+    order = np.argsort(score, kind='stable')
+    start = (page - 1) * per_page
+    offers = []
+    for i in order[start:start + per_page]:
+        offer = book_instances[i]._asdict()
+        offer['distance'] = (
+            None if distances is None or np.isnan(distances[i])
+            else float(distances[i]))
+        offers.append(offer)
+    return offers, pages
+
+
 def generate_map_single_marker(
         height=200,
         zoom_start=12,
         location=None,
-        popup='popup content'):
+        popup='popup content') -> str:
+    """ Returns html of the map with one marker """
 
     if ((location is None) and current_user):
         location = (current_user.latitude, current_user.longitude)
-    m = folium.Map(
-        height=height,
-        location=location,
-        zoom_start=zoom_start
-    )
-    folium.Marker(
-        location=location,
-        popup=popup,
-        icon=folium.Icon(color='green')
-    ).add_to(m)
-    m.save('project/templates/_map.html')
 
+    def _render() -> str:
+        m = folium.Map(
+            height=height,
+            location=location,
+            zoom_start=zoom_start
+        )
+        folium.Marker(
+            location=location,
+            popup=popup,
+            icon=folium.Icon(color='green')
+        ).add_to(m)
+        return m.get_root().render()
+
+    key = ('single_marker', tuple(location), height, zoom_start, popup)
+    return _get_cached_map(key, _render)
+
+
+def get_map_data(
+        book_ids: Union[List[int], None] = None,
+        bbox: Union[tuple, None] = None) -> dict:
+    """ Returns GeoJSON FeatureCollection of active book instances.
+
+    Properties are short to keep the response small:
+     - bi: BookInstance.id
+     - b: Book.id
+     - p: price
+     - c: cover id (0 if the book has no cover)
+     - t: book title
+    """
+    features = []
+    for bi_id, book_id, price, latitude, longitude, title in (
+            get_active_bi_locations(
+                book_ids=book_ids,
+                bbox=bbox,
+                limit=current_app.config['MAP_MARKERS_LIMIT'])):
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+            'properties': {
+                'bi': bi_id,
+                'b': book_id,
+                'p': price,
+                'c': get_cover_id(book_id),
+                't': title,
+            },
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def generate_map_by_book_id(book_ids: list) -> str:
+    """ Returns html of the map with all active book instances locations.
+
+    The map is rendered in the browser: markers are loaded from
+    /api/map_data and clustered by Leaflet.markercluster.
+    """
+    map_location = current_app.config["DEFAULT_MAP_COORDINADES"]
+    if not current_user.is_anonymous:
+        map_location = (current_user.latitude, current_user.longitude)
 
-def generate_map_by_book_id(book_ids: list):
-    """ Show all active book instances locations """
+    data_url = url_for(
+        'map_data',
+        book_ids=','.join(str(i) for i in sorted(set(book_ids))))
+    return render_template(
+        '_map.html',
+        map_location=map_location,
+        data_url=data_url,
+        basedir=current_app.config['BASEDIR'],
+    )
 
-    def _generate_popup(bi, book_title: str) -> str:
-        """ Concatenate str & vars to generate html code of Marker popup """
 
-        filepath = "/static/covers/" + str(bi.book_id) + ".jpg"
-        if not os.path.exists('project' + filepath):
-            filepath = "/static/covers/0.jpg"
-        parts = (book_title, '</br><a href=', current_app.config["BASEDIR"],
-                 'bi/', str(bi.id), '><img src="', filepath, '" width="50" height="70" >',
-                 '</a></br>', str(bi.price), ' ₴')
-        popup = ''.join(parts)
-        return popup
+def generate_clusters_map() -> str:
+    """ Returns html of the map with all active book instances.
 
+    Clusters are loaded by map tiles from /api/clusters (precomputed, see
+    clusters.py), separate markers are loaded from /api/map_data by the map
+    bbox when zoomed in deeper than clusters max zoom.
+    """
     map_location = current_app.config["DEFAULT_MAP_COORDINADES"]
     if not current_user.is_anonymous:
         map_location = (current_user.latitude, current_user.longitude)
 
-    m = folium.Map(
-        height=500,
-        location=map_location,
-        zoom_start=12
+    tiles_url = url_for('cluster_tile', z=0, x=0, y=0).rsplit('/0/0/0', 1)[0]
+    return render_template(
+        '_map.html',
+        map_location=map_location,
+        data_url=url_for('map_data'),
+        tiles_url=tiles_url,
+        clusters_max_zoom=cluster_index.max_zoom,
+        basedir=current_app.config['BASEDIR'],
     )
-    books = Book.query.filter(Book.id.in_(book_ids)).all()
-    # create a marker cluster
-    marker_cluster = folium.plugins.MarkerCluster().add_to(m)
 
-    # used to decrease db load
-    location_cache = dict()
 
-    for book in books:
-        for bi in [bi for bi in book.BookInstance if bi.is_active]:
-            if not location_cache.get(bi.owner_id):
-                user = get_user_by_id(bi.owner_id)
-                location = (user.latitude, user.longitude)
-                location_cache[bi.owner_id] = location
+def rebuild_clusters_job():
+    """ Background job, see clusters.py: only the index the process uses """
+    if not cluster_index.is_used:
+        return
+    with app.app_context():
+        rebuild_clusters()
 
-            # 'no-cover image' if no cover image found
-            cover_id = bi.book_id if os.path.isfile(
-                f'project/static/covers/{bi.book_id}.jpg') else 0
 
-            icon_url = (''.join((current_app.config["IMAGE_UPLOADS"], '/',
-                                 str(cover_id), '.jpg'))
-                        )
+def trim_fresh_listings_job():
+    """ Background job, see db_handlers.trim_fresh_listings """
+    with app.app_context():
+        trim_fresh_listings()
 
-            folium.Marker(
-                location=list(location),
-                icon=folium.features.CustomIcon(icon_url, icon_size=(30, 50)),
-                popup=_generate_popup(bi, book.title)
-            ).add_to(marker_cluster)
-    m.save('project/templates/_map.html')
+
+def rollup_daily_stats_job():
+    """ Background job, see db_handlers.rollup_daily_stats """
+    with app.app_context():
+        rollup_daily_stats()
 
 
 def get_coordinates_by_ip(visitor_ip: str) -> tuple:
@@ -141,11 +416,21 @@ def get_coordinates_by_ip(visitor_ip: str) -> tuple:
     return longitude, latitude
 
 
-def expired_bi_handler():
+def expired_bi_handler(
+        expiration_period_days: int = 30,
+        chunk_size: int = 1000) -> dict:
     """
-    Collected all expired book instances by expiration time
-    Send email notificasions to these books owners
-    Deactivated all expired books. (in one separate request)
+    Collects expired book instances chunk by chunk (keyset over
+    (owner_id, id), so memory use doesn't depend on the number of them),
+    sends email notification to each owner (one per owner) and deactivates
+    the instances of the notified owners, a chunk in its own transaction.
+    Logs progress after every chunk.
+
+    An owner whose email failed keeps the instances active, so they are
+    found and the owner is notified again by the next run.
+
+    Returns the metrics: chunks, book_instances, deactivated, emails,
+    failed_emails, seconds.
 
     for DBG emails use data:
     expired_bis = {'kovalyov.volodymyr@gmail.com': [
@@ -154,22 +439,69 @@ def expired_bi_handler():
         {'id': 27, 'title': 'The Great Gatsby 3', 'author': 'Andersen 3'}
         ]}
     """
-
-    # Get & pack expired_bi to dict{email: [bi_1, bi_2...], ...}:
-    expired_bis = dict()
-    for email, bi_id, title, author in get_expired_bi_with_users():
-        expired_bi = {'id': bi_id, 'title': title, 'author': author}
-        if expired_bis.get(email) is None:
-            expired_bis[email] = [expired_bi]
-        else:
-            expired_bis[email].append(expired_bi)
-
-    # Send an email to each user
-    for email, expired_bis in expired_bis.items():
-        send_email_bi_is_expired(email, expired_bis)
-
-    # Deactivate all expired books
-    deactivate_any_bi_if_expired()
+    expiration_time = datetime.utcnow() - timedelta(days=expiration_period_days)
+    metrics = {'chunks': 0, 'book_instances': 0, 'deactivated': 0,
+               'emails': 0, 'failed_emails': 0, 'seconds': 0.0}
+    start = time.monotonic()
+    # the owner's instances may continue in the next chunk
+    owner_id, owner_email, owner_bis = None, None, []
+    notified_bi_ids = []  # to deactivate
+
+    def notify_owner():
+        if not owner_bis:
+            return
+        try:
+            send_email_bi_is_expired(owner_email, owner_bis,
+                                     asynchronous=False)
+        except Exception:
+            app.logger.exception(f'Expired book instances email to user '
+                                 f'{owner_id} failed, retry next run')
+            metrics['failed_emails'] += 1
+            return
+        metrics['emails'] += 1
+        notified_bi_ids.extend(bi['id'] for bi in owner_bis)
+
+    def deactivate_notified():
+        if notified_bi_ids:
+            metrics['deactivated'] += deactivate_book_instances(
+                notified_bi_ids)
+            notified_bi_ids.clear()
+
+    after = None
+    while True:
+        rows = get_expired_bi_chunk(expiration_time, after, chunk_size)
+        if not rows:
+            break
+        for row_owner_id, email, bi_id, title, author in rows:
+            if row_owner_id != owner_id:
+                notify_owner()
+                owner_id, owner_email, owner_bis = row_owner_id, email, []
+            owner_bis.append({'id': bi_id, 'title': title, 'author': author})
+        deactivate_notified()
+        metrics['chunks'] += 1
+        metrics['book_instances'] += len(rows)
+        metrics['seconds'] = time.monotonic() - start
+        app.logger.info('Expired book instances: {chunks} chunks, '
+                        '{book_instances} found, {deactivated} deactivated, '
+                        '{emails} emails, {failed_emails} failed emails, '
+                        '{seconds:.1f} s'.format(**metrics))
+        after = (rows[-1].owner_id, rows[-1].id)
+    notify_owner()
+    deactivate_notified()
+    metrics['seconds'] = time.monotonic() - start
+    if metrics['deactivated']:
+        clear_map_cache()
+    return metrics
+
+
+def expired_bi_job():
+    """ Background job, see expired_bi_handler() """
+    with app.app_context():
+        if current_app.config['CHECK_EXPIRED_BOOK_INSTANCES']:
+            expired_bi_handler(
+                current_app.config['EXPIRATION_PERIOD_DAYS'],
+                current_app.config['EXPIRED_BI_CHUNK_SIZE'],
+            )
 
 
 def allow_create_new_book(current_user_id: int, limit: int) -> bool: